@@ -1,33 +1,48 @@
 import os
 import asyncio
+import bisect
 import calendar
+import functools
+import gzip
 import json
 import csv
 import io
 import logging
 import re
-from datetime import datetime, date
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta
+from itertools import islice
 from math import radians, sin, cos, sqrt, atan2
+from operator import itemgetter
 from typing import Optional, Dict, Tuple, List, Union
+from zoneinfo import ZoneInfo
 
 from dotenv import load_dotenv
-import pytz
 
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.types import Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, BufferedInputFile
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import (
+    CopyMessage, EditMessageReplyMarkup, EditMessageText, SendDocument, SendMessage,
+)
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.filters.callback_data import CallbackData
 
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from contextlib import asynccontextmanager
 
 import gspread
 from gspread.worksheet import Worksheet
 from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
 
 # ============================================================
 # CONFIG
@@ -40,7 +55,8 @@ CREDENTIALS_JSON = os.getenv("GOOGLE_CREDENTIALS")
 CREDENTIALS_FILE = os.getenv("GOOGLE_CREDENTIALS_FILE")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 PORT = int(os.getenv("PORT", 8000))
-TIMEZONE = pytz.timezone("Europe/Rome")
+REDIS_URL = os.getenv("REDIS_URL")
+TIMEZONE = ZoneInfo("Europe/Rome")
 
 if not TOKEN:
     raise RuntimeError("BOT_TOKEN non impostato nelle variabili d'ambiente.")
@@ -50,17 +66,102 @@ ADMINS = {614102287}
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
 logger = logging.getLogger(__name__)
 
-bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-dp = Dispatcher(storage=MemoryStorage())
+# ============================================================
+# Telegram: limite di invio (token bucket)
+# ============================================================
+# Telegram accetta ~30 messaggi/s in totale e ~1/s per chat: oltre risponde 429
+# con attese anche di decine di secondi. Meglio distribuire i picchi qui.
+_RATE_LIMITED_METHODS = (SendMessage, SendDocument, CopyMessage, EditMessageText, EditMessageReplyMarkup)
+
+
+class _TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        # Prende un token anche se non c'è (saldo negativo = coda) e
+        # restituisce i secondi da attendere prima di usarlo.
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class TelegramRateLimit(BaseRequestMiddleware):
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0, chat_burst: float = 3.0):
+        self._global = _TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chats: Dict[Union[int, str], _TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> _TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 1000:
+                # Le chat inattive hanno il secchio pieno: si possono scartare.
+                now = time.monotonic()
+                self._chats = {
+                    k: b for k, b in self._chats.items()
+                    if b.tokens + (now - b.updated) * b.rate < b.capacity
+                }
+            bucket = self._chats[chat_id] = _TokenBucket(self._chat_rate, self._chat_burst)
+        return bucket
+
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, _RATE_LIMITED_METHODS):
+            wait = self._global.reserve()
+            chat_id = getattr(method, "chat_id", None)
+            if chat_id is not None:
+                wait = max(wait, self._chat_bucket(chat_id).reserve())
+            if wait > 0:
+                await asyncio.sleep(wait)
+        return await make_request(bot, method)
+
+
+# Una sola sessione aiohttp con pool keep-alive verso Telegram. Timeout per
+# richiesta a 15 s invece dei 60 di default: una chiamata bloccata non tiene
+# fermo l'handler per un minuto.
+bot = Bot(
+    token=TOKEN,
+    session=AiohttpSession(limit=100, timeout=15.0),
+    default=DefaultBotProperties(parse_mode="HTML"),
+)
+bot.session.middleware(TelegramRateLimit())
+
+
+def _build_fsm_storage():
+    # Con REDIS_URL gli stati FSM sopravvivono ai riavvii e sono condivisi tra
+    # istanze; senza, restano in memoria come prima.
+    if not REDIS_URL:
+        return MemoryStorage()
+    from aiogram.fsm.storage.redis import RedisStorage
+    logger.info("Stati FSM su Redis")
+    return RedisStorage.from_url(REDIS_URL, connection_kwargs={"max_connections": 32})
+
+
+dp = Dispatcher(storage=_build_fsm_storage())
 
 _sheets_semaphore = asyncio.Semaphore(3)
+# Pool dedicato alle chiamate gspread, separato dal default executor: le
+# richieste lente verso Google non tolgono thread al resto del bot. Più largo
+# del semaforo perché un thread abbandonato dopo un timeout resta occupato
+# finché la richiesta HTTP non si chiude.
+_sheets_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="sheets")
 
 
 async def sheets_call(fn, *args, timeout: float = 15.0):
     async with _sheets_semaphore:
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout
         try:
             return await asyncio.wait_for(
-                asyncio.to_thread(fn, *args),
+                loop.run_in_executor(_sheets_executor, functools.partial(_run_until, deadline, fn, *args)),
                 timeout=timeout
             )
         except asyncio.TimeoutError:
@@ -69,15 +170,58 @@ async def sheets_call(fn, *args, timeout: float = 15.0):
             raise
 
 
-_sent_ingresso_today: Dict[int, date] = {}
-_sent_uscita_today: Dict[int, date] = {}
+# ============================================================
+# Date helpers
+# ============================================================
+DATE_FMT = "%d.%m.%Y"  # formato della colonna Data nei fogli
+
+
+@functools.lru_cache(maxsize=2)
+def _format_day(day: date) -> str:
+    return day.strftime(DATE_FMT)
+
+
+# Data di oggi già formattata, valida fino alla prossima mezzanotte di Roma
+# (timestamp epoch): per la data corrente basta un time.time().
+_today_cache: Tuple[float, str] = (0.0, "")
+
+
+def today_str(now: Optional[datetime] = None) -> str:
+    global _today_cache
+    if now is not None:
+        return _format_day(now.date())
+    expires, day = _today_cache
+    if time.time() < expires:
+        return day
+    now = datetime.now(TIMEZONE)
+    day = _format_day(now.date())
+    midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), tzinfo=TIMEZONE)
+    _today_cache = (midnight.timestamp(), day)
+    return day
+
+
+def hhmm_str(now: Optional[datetime] = None) -> str:
+    if now is None:
+        now = datetime.now(TIMEZONE)
+    return f"{now.hour:02d}:{now.minute:02d}"
 
 
 # ============================================================
-# Google Sheets: client thread-local (thread-safe)
+# Google Sheets: client condiviso con sessione HTTP persistente
 # ============================================================
 import threading
-_thread_local = threading.local()
+_client_lock = threading.Lock()
+# Scadenza (time.monotonic()) della sheets_call eseguita da questo thread: dopo
+# di essa il chiamante ha già rinunciato e _retry non avvia altre richieste.
+_call_deadline = threading.local()
+_client: Optional[gspread.Client] = None
+# Handle già aperti: open_by_key/worksheet costano una chiamata HTTP l'uno,
+# li riapriamo solo dopo un reset del client o allo scadere del TTL (un foglio
+# rinominato o ricreato non resta agganciato per sempre a un id vecchio).
+_spreadsheet: Optional[gspread.Spreadsheet] = None
+_sheets_cache: Dict[str, Worksheet] = {}
+_SHEETS_CACHE_TTL = 3600.0
+_sheets_cache_expires = 0.0  # time.monotonic()
 
 SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
@@ -85,78 +229,285 @@ SCOPES = [
 ]
 
 
+def _parse_credentials_json(raw: Optional[str]) -> Optional[dict]:
+    if not raw:
+        return None
+    try:
+        credentials_dict = json.loads(raw)
+    except Exception as e:
+        logger.exception("Errore parsing GOOGLE_CREDENTIALS: %s", e)
+        return None
+    if "private_key" in credentials_dict and isinstance(credentials_dict["private_key"], str):
+        credentials_dict["private_key"] = credentials_dict["private_key"].replace("\\n", "\n")
+    return credentials_dict
+
+
+# Il JSON delle credenziali si legge una volta, all'import.
+_CREDENTIALS_INFO = _parse_credentials_json(CREDENTIALS_JSON)
+
+
+# Le credenziali sopravvivono ai reset del client (timeout, errori di rete):
+# niente nuovo parsing del JSON e della chiave RSA, e il token già ottenuto
+# resta valido fino alla scadenza. Si buttano solo su un 401.
+@functools.lru_cache(maxsize=1)
 def _build_creds():
     if not (CREDENTIALS_JSON or CREDENTIALS_FILE):
         raise ValueError("Devi impostare GOOGLE_CREDENTIALS o GOOGLE_CREDENTIALS_FILE.")
     if CREDENTIALS_JSON:
-        try:
-            credentials_dict = json.loads(CREDENTIALS_JSON)
-        except Exception as e:
-            logger.exception("Errore parsing GOOGLE_CREDENTIALS: %s", e)
-            raise
-        if "private_key" in credentials_dict and isinstance(credentials_dict["private_key"], str):
-            credentials_dict["private_key"] = credentials_dict["private_key"].replace("\\n", "\n")
-        return Credentials.from_service_account_info(credentials_dict, scopes=SCOPES)
+        if _CREDENTIALS_INFO is None:
+            raise ValueError("GOOGLE_CREDENTIALS non è un JSON valido.")
+        return Credentials.from_service_account_info(_CREDENTIALS_INFO, scopes=SCOPES)
     return Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
 
 
+# Timeout (connessione, lettura) delle richieste HTTP verso Google. Senza,
+# requests aspetta all'infinito e un thread abbandonato da sheets_call resta
+# occupato finché Google non chiude la connessione.
+_HTTP_TIMEOUT = (5, 20)
+
+
+def _build_session(creds: Credentials) -> AuthorizedSession:
+    # Un'unica sessione per processo: le connessioni TLS verso Google restano
+    # nel pool e vengono riusate da tutti i thread invece di rinegoziarle.
+    session = AuthorizedSession(creds)
+    session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=50))
+    return session
+
+
 def _get_client() -> gspread.Client:
-    if not hasattr(_thread_local, "client") or _thread_local.client is None:
-        _thread_local.client = gspread.authorize(_build_creds())
-        logger.debug("Nuovo client gspread per thread %s", threading.current_thread().name)
-    return _thread_local.client
+    global _client
+    with _client_lock:
+        if _client is None:
+            creds = _build_creds()
+            _client = gspread.Client(auth=creds, session=_build_session(creds))
+            _client.set_timeout(_HTTP_TIMEOUT)
+            logger.debug("Nuovo client gspread (sessione condivisa)")
+        return _client
+
+
+def _invalidate_sheets_cache():
+    # Butta solo gli handle: client, sessione e token restano validi.
+    global _spreadsheet, _sheets_cache_expires
+    _spreadsheet = None
+    _sheets_cache.clear()
+    _sheets_cache_expires = time.monotonic() + _SHEETS_CACHE_TTL
 
 
 def _reset_client():
-    if hasattr(_thread_local, "client"):
-        _thread_local.client = None
+    global _client
+    with _client_lock:
+        _client = None
+        _invalidate_sheets_cache()
+
+
+def _get_spreadsheet() -> gspread.Spreadsheet:
+    global _spreadsheet
+    spreadsheet = _spreadsheet
+    if spreadsheet is None:
+        spreadsheet = _get_client().open_by_key(SHEET_ID)
+        _spreadsheet = spreadsheet
+    return spreadsheet
 
 
 def get_sheet(sheet_name: str = "Registro") -> Worksheet:
+    if time.monotonic() >= _sheets_cache_expires:
+        _invalidate_sheets_cache()
+    sheet = _sheets_cache.get(sheet_name)
+    if sheet is not None:
+        return sheet
     try:
-        return _get_client().open_by_key(SHEET_ID).worksheet(sheet_name)
+        sheet = _get_spreadsheet().worksheet(sheet_name)
+        _sheets_cache[sheet_name] = sheet
+        return sheet
     except gspread.exceptions.APIError as e:
         if e.response.status_code == 401:
+            _build_creds.cache_clear()
             _reset_client()
-            logger.warning("Token scaduto, client resettato (thread %s).", threading.current_thread().name)
+            logger.warning("Token scaduto, client resettato.")
         logger.exception("Errore aprendo il foglio '%s': %s", sheet_name, e)
         raise
+    except gspread.exceptions.WorksheetNotFound:
+        # Foglio opzionale assente: il client è sano, non buttiamo la cache.
+        logger.warning("Foglio '%s' non trovato.", sheet_name)
+        raise
     except Exception as e:
         _reset_client()
         logger.exception("Errore aprendo il foglio '%s': %s", sheet_name, e)
         raise
 
 
+def _run_until(deadline: float, fn, *args):
+    if time.monotonic() >= deadline:
+        # Rimasta in coda nel pool oltre il timeout: il chiamante ha già rinunciato.
+        raise TimeoutError(f"{fn.__name__} scaduta prima di partire")
+    _call_deadline.value = deadline
+    try:
+        return fn(*args)
+    finally:
+        _call_deadline.value = None
+
+
+# Ritentativi su quota superata (429) ed errori temporanei di Google. Un
+# tentativo parte solo prima della scadenza della sheets_call e un'attesa
+# (1, 2, 4 s) solo se finisce prima di essa: un thread abbandonato dopo un
+# timeout può ancora scrivere al massimo per la durata di una richiesta
+# (_HTTP_TIMEOUT), non per tutti i ritentativi.
+_RETRY_DELAYS = (1.0, 2.0, 4.0)
+_RETRY_5XX = {500, 502, 503, 504}
+
+
+def _retry(fn, *args, idempotent: bool = True, **kwargs):
+    # Un 5xx non garantisce che la scrittura non sia avvenuta: le chiamate non
+    # idempotenti (append) si ritentano solo sul 429, che è sempre un rifiuto.
+    deadline = getattr(_call_deadline, "value", None)
+    for delay in _RETRY_DELAYS + (None,):
+        if deadline is not None and time.monotonic() >= deadline:
+            raise TimeoutError(f"{fn.__name__}: timeout di sheets_call scaduto")
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            status = e.response.status_code
+            if status in (400, 404):
+                # Range non valido o foglio sparito: probabile handle vecchio
+                # (foglio rinominato/ricreato), alla prossima get_sheet si riapre.
+                _invalidate_sheets_cache()
+            if delay is None or not (status == 429 or (idempotent and status in _RETRY_5XX)):
+                raise
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                raise
+            logger.warning("Sheets %s su %s, nuovo tentativo tra %.0fs", status, fn.__name__, delay)
+            time.sleep(delay)
+
+
+def _append_rows(sheet: Worksheet, rows: List[List[str]]) -> dict:
+    # Una sola chiamata values:append con opzioni esplicite: valori RAW (niente
+    # parsing lato Sheets), tabella ancorata ad A1 e righe sempre inserite in
+    # fondo invece di sovrascrivere eventuali righe vuote formattate.
+    return _retry(
+        sheet.append_rows,
+        rows,
+        idempotent=False,
+        value_input_option="RAW",
+        insert_data_option="INSERT_ROWS",
+        table_range="A1",
+    )
+
+
+def _append_row(sheet: Worksheet, values: List[str]) -> dict:
+    return _append_rows(sheet, [values])
+
+
+def _find_row(sheet: Worksheet, value: str, col: int = 1) -> Optional[int]:
+    # Scarica la sola colonna chiave invece dell'intero foglio.
+    for i, cell in enumerate(islice(sheet.col_values(col), 1, None), start=2):
+        if cell.strip() == value:
+            return i
+    return None
+
+
+# ============================================================
+# Coda di scrittura: append raggruppati per foglio
+# ============================================================
+# Gli handler mettono in coda la riga e attendono il numero di riga scritto.
+# Un solo task svuota la coda: le righe arrivate mentre un append è in volo
+# partono insieme nel successivo (max _WRITE_BATCH_MAX), così un picco di
+# ingressi alle 9:00 costa poche chiamate invece di una per utente.
+_WRITE_BATCH_MAX = 20
+_write_q: Optional[asyncio.Queue] = None
+_write_flusher_task: Optional[asyncio.Task] = None
+
+
+def _sync_append_rows(sheet_name: str, rows: List[List[str]]) -> dict:
+    return _append_rows(get_sheet(sheet_name), rows)
+
+
+async def queue_append(sheet_name: str, values: List[str]) -> Optional[int]:
+    if _write_q is None:
+        response = await sheets_call(_sync_append_rows, sheet_name, [values])
+        return _appended_row(response)
+    fut = asyncio.get_running_loop().create_future()
+    await _write_q.put((sheet_name, values, fut))
+    return await fut
+
+
+async def _write_flusher() -> None:
+    while True:
+        batch = [await _write_q.get()]
+        while len(batch) < _WRITE_BATCH_MAX and not _write_q.empty():
+            batch.append(_write_q.get_nowait())
+
+        by_sheet: Dict[str, list] = {}
+        for item in batch:
+            by_sheet.setdefault(item[0], []).append(item)
+
+        for sheet_name, items in by_sheet.items():
+            try:
+                response = await sheets_call(
+                    _sync_append_rows, sheet_name, [values for _, values, _ in items]
+                )
+            except Exception as e:
+                logger.error("Append su '%s' fallito (%d righe): %s", sheet_name, len(items), e)
+                for _, _, fut in items:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            first_row = _appended_row(response)
+            for offset, (_, _, fut) in enumerate(items):
+                if not fut.done():
+                    fut.set_result(first_row + offset if first_row is not None else None)
+
+        for _ in batch:
+            _write_q.task_done()
+
+
 # ============================================================
 # Caching work_locations con TTL (5 minuti)
 # ============================================================
 _work_locations_cache: Optional[Dict[str, Tuple[float, float]]] = None
-_work_locations_cache_time: Optional[datetime] = None
+# Scadenza su time.monotonic(): non risente di cambi d'ora o correzioni NTP.
+_work_locations_expires: float = 0.0
+# Stesse zone già convertite per check_location, ordinate per latitudine:
+# (nome, lat_rad, lon_rad, cos(lat), semiampiezza del riquadro in longitudine)
+_work_locations_rad: List[Tuple[str, float, float, float, float]] = []
 _CACHE_TTL_SECONDS = 300
+# Se il foglio non risponde si riprova dopo questo intervallo, non a ogni posizione.
+_CACHE_RETRY_SECONDS = 30
 
 WORK_LOCATIONS = {
     "Ufficio Centrale": (45.6204762, 9.2401744),
 }
 MAX_DISTANCE_METERS = 200
+EARTH_RADIUS_METERS = 6371000
+# Raggio massimo espresso come angolo: è anche la semiampiezza del riquadro in latitudine
+_MAX_DISTANCE_RAD = MAX_DISTANCE_METERS / EARTH_RADIUS_METERS
+# Soglia sul termine "a" dell'haversine: d <= MAX  <=>  a <= sin²(MAX / 2R)
+_HAVERSINE_A_MAX = sin(_MAX_DISTANCE_RAD / 2) ** 2
+
+
+_zone_lat = itemgetter(1)
+
+
+def _locations_to_rad(locs: Dict[str, Tuple[float, float]]) -> List[Tuple[str, float, float, float, float]]:
+    zones = []
+    for name, (lat, lon) in locs.items():
+        cos_lat = cos(radians(lat))
+        zones.append((name, radians(lat), radians(lon), cos_lat, _MAX_DISTANCE_RAD / max(cos_lat, 1e-6)))
+    zones.sort(key=_zone_lat)
+    return zones
 
 
 def get_work_locations() -> Dict[str, Tuple[float, float]]:
-    global _work_locations_cache, _work_locations_cache_time
+    global _work_locations_cache, _work_locations_expires, _work_locations_rad
 
-    now = datetime.now(TIMEZONE)
-    cache_valid = (
-        _work_locations_cache is not None
-        and _work_locations_cache_time is not None
-        and (now - _work_locations_cache_time).total_seconds() < _CACHE_TTL_SECONDS
-    )
-    if cache_valid:
+    now = time.monotonic()
+    if _work_locations_cache is not None and now < _work_locations_expires:
         return _work_locations_cache
 
     try:
         sheet = get_sheet("ZoneLavoro")
         rows = sheet.get_all_values()
         locs: Dict[str, Tuple[float, float]] = {}
-        for row in rows[1:]:
+        for row in islice(rows, 1, None):
             if len(row) >= 3:
                 name = row[0].strip()
                 if not name:
@@ -168,24 +519,33 @@ def get_work_locations() -> Dict[str, Tuple[float, float]]:
                 locs[name] = (lat, lon)
 
         result = locs if locs else WORK_LOCATIONS.copy()
+        _work_locations_rad = _locations_to_rad(result)
         _work_locations_cache = result
-        _work_locations_cache_time = now
+        _work_locations_expires = now + _CACHE_TTL_SECONDS
         return result
     except Exception as e:
-        logger.warning("Impossibile leggere ZoneLavoro, uso fallback statico: %s", e)
-        return WORK_LOCATIONS.copy()
+        # Anche l'errore va in cache: si continua con le ultime zone note (o con
+        # quelle statiche) e si riprova solo tra _CACHE_RETRY_SECONDS.
+        if _work_locations_cache is None:
+            logger.warning("Impossibile leggere ZoneLavoro, uso fallback statico: %s", e)
+            _work_locations_rad = _locations_to_rad(WORK_LOCATIONS)
+            _work_locations_cache = WORK_LOCATIONS.copy()
+        else:
+            logger.warning("Impossibile leggere ZoneLavoro, uso le ultime zone note: %s", e)
+        _work_locations_expires = now + _CACHE_RETRY_SECONDS
+        return _work_locations_cache
 
 
 def _invalidate_locations_cache() -> None:
-    global _work_locations_cache, _work_locations_cache_time
+    global _work_locations_cache, _work_locations_expires
     _work_locations_cache = None
-    _work_locations_cache_time = None
+    _work_locations_expires = 0.0
 
 
 def save_new_zone(name: str, lat: float, lon: float) -> bool:
     try:
         sheet = get_sheet("ZoneLavoro")
-        sheet.append_row([name, str(lat), str(lon)])
+        _append_row(sheet, [name, str(lat), str(lon)])
         _invalidate_locations_cache()
         return True
     except Exception as e:
@@ -196,13 +556,12 @@ def save_new_zone(name: str, lat: float, lon: float) -> bool:
 def update_zone_name(old_name: str, new_name: str) -> bool:
     try:
         sheet = get_sheet("ZoneLavoro")
-        rows = sheet.get_all_values()
-        for i, row in enumerate(rows[1:], start=2):
-            if len(row) >= 3 and row[0] == old_name:
-                sheet.update_cell(i, 1, new_name)
-                _invalidate_locations_cache()
-                return True
-        return False
+        i = _find_row(sheet, old_name)
+        if i is None:
+            return False
+        sheet.update_cell(i, 1, new_name)
+        _invalidate_locations_cache()
+        return True
     except Exception as e:
         logger.exception("Errore aggiornamento zona: %s", e)
         return False
@@ -211,13 +570,12 @@ def update_zone_name(old_name: str, new_name: str) -> bool:
 def delete_zone(name: str) -> bool:
     try:
         sheet = get_sheet("ZoneLavoro")
-        rows = sheet.get_all_values()
-        for i, row in enumerate(rows[1:], start=2):
-            if len(row) >= 3 and row[0] == name:
-                sheet.delete_rows(i)
-                _invalidate_locations_cache()
-                return True
-        return False
+        i = _find_row(sheet, name)
+        if i is None:
+            return False
+        sheet.delete_rows(i)
+        _invalidate_locations_cache()
+        return True
     except Exception as e:
         logger.exception("Errore rimozione zona: %s", e)
         return False
@@ -226,98 +584,436 @@ def delete_zone(name: str) -> bool:
 # ============================================================
 # Google Sheets helpers – Registro presenze
 # ============================================================
+# Colonna "Utente" = "Nome | id". L'indice evita rsplit/int ripetuti
+# sulle stesse chiavi a ogni giro dello scheduler.
+_USER_INDEX: Dict[str, Tuple[str, int]] = {}
+
 
-async def async_save_ingresso(user: types.User, time_str: str, location_name: str) -> bool:
-    return await sheets_call(_sync_save_ingresso, user, time_str, location_name)
+def _user_key(user: types.User) -> str:
+    key = f"{user.full_name} | {user.id}"
+    _USER_INDEX[key] = (user.full_name, user.id)
+    return key
 
-def _sync_save_ingresso(user: types.User, time_str: str, location_name: str) -> bool:
+
+def _parse_user_key(key: str) -> Optional[Tuple[str, int]]:
+    parsed = _USER_INDEX.get(key)
+    if parsed is None:
+        nome, sep, uid = key.rpartition(" | ")
+        if not sep:
+            return None
+        try:
+            parsed = (nome, int(uid))
+        except ValueError:
+            return None
+        _USER_INDEX[key] = parsed
+    return parsed
+
+
+# Indice delle presenze di oggi: user_id -> (riga, uscita già registrata).
+# Ingresso/uscita non scaricano più tutto il Registro: l'indice si costruisce
+# una volta al giorno leggendo la colonna A e le sole righe di oggi, e prima
+# di usare una riga la si ricontrolla sul foglio (può essere stato modificato
+# a mano).
+_registro_lock = threading.Lock()
+_today: Optional[str] = None
+_today_index: Dict[str, Tuple[int, bool]] = {}
+# Indice di oggi da rileggere al prossimo uso (stesso giorno: le prenotazioni
+# in corso e le loro scadenze si conservano).
+_today_stale = False
+_PENDING_ROW = 0  # ingresso prenotato, riga ancora in coda di scrittura
+# Ingressi con esito ignoto (timeout, errore di rete, 5xx): il thread può ancora
+# scrivere la riga, quindi la prenotazione resta fino alla scadenza e poi si
+# rilegge il foglio. Dopo il timeout di sheets_call _retry non avvia nuove
+# richieste: resta al più quella in corso, limitata da _HTTP_TIMEOUT (più margine,
+# perché il timeout di lettura vale per singola lettura dal socket).
+_UNCERTAIN_TTL = sum(_HTTP_TIMEOUT) + 30.0
+_pending_expires: Dict[str, float] = {}  # user_id -> time.monotonic()
+_APPENDED_ROW_RE = re.compile(r"![A-Z]+(\d+)")
+
+# Copia locale del Registro per il riepilogo: _registro_rows[i - 2] è la riga i
+# del foglio. Si scarica all'avvio e poi si aggiorna con le scritture fatte da
+# questo processo; None = da riscaricare al prossimo uso. Dopo il TTL si
+# riscarica comunque, per raccogliere le modifiche fatte a mano sul foglio.
+# Protetta da _registro_lock.
+_registro_rows: Optional[List[List[str]]] = None
+_REGISTRO_ROWS_TTL = 600
+_registro_rows_expires = 0.0  # time.monotonic()
+# Aumenta a ogni scrittura riportata nelle cache: dice se un download
+# iniziato prima può aver perso qualche riga.
+_registro_version = 0
+
+
+def _download_registro_rows(sheet: Worksheet) -> List[List[str]]:
+    rows = sheet.get_all_values()
+    del rows[:1]  # intestazione, senza copiare la lista
+    return rows
+
+
+def _install_registro_rows(rows: List[List[str]]) -> None:
+    """Va chiamata tenendo _registro_lock."""
+    global _registro_rows, _registro_rows_expires
+    _registro_rows = rows
+    _registro_rows_expires = time.monotonic() + _REGISTRO_ROWS_TTL
+
+
+def _refresh_registro_rows() -> None:
+    """Riscarica la copia locale se assente o scaduta. Da chiamare senza _registro_lock."""
+    with _registro_lock:
+        if _registro_rows is not None and time.monotonic() < _registro_rows_expires:
+            return
+        version = _registro_version
+    # Il foglio intero si scarica fuori dal lock: ingressi, uscite e scheduler
+    # non devono aspettarlo.
+    try:
+        rows = _download_registro_rows(get_sheet("Registro"))
+    except Exception as e:
+        # Meglio una copia vecchia di qualche minuto che nessuna copia.
+        logger.warning("Copia locale del Registro non aggiornata: %s", e)
+        return
+    with _registro_lock:
+        if _registro_version != version:
+            # Scritture arrivate durante il download: potrebbero mancare nella
+            # copia scaricata, si tiene quella attuale e si riprova al prossimo uso.
+            logger.info("Registro modificato durante il download, copia locale non sostituita.")
+            return
+        _install_registro_rows(rows)
+
+
+def _registro_rows_set(i: int, col: int, values: List[str]) -> None:
+    """Riporta sulla copia locale una scrittura sul foglio (riga i, da colonna col)."""
+    if _registro_rows is None:
+        return
+    while len(_registro_rows) < i - 1:
+        _registro_rows.append([])
+    row = _registro_rows[i - 2]
+    end = col - 1 + len(values)
+    if len(row) < end:
+        row.extend([""] * (end - len(row)))
+    row[col - 1:end] = values
+
+
+def _load_today_index(sheet: Worksheet, today: str) -> None:
+    global _today, _today_stale
+    # Si scarica solo la colonna delle date; poi, se oggi ci sono righe, un'unica
+    # batch_get delle colonne che servono (Data, Utente, Ingresso ora, Uscita)
+    # limitata all'intervallo che le contiene (sono in fondo al foglio). Le
+    # posizioni non servono all'indice e non si scaricano.
+    dates = sheet.col_values(1)
+    today_rows = [i for i, d in enumerate(dates, start=1) if i > 1 and d == today]
+    rows: List[Tuple[List[str], bool]] = []
+    if today_rows:
+        first, last = today_rows[0], today_rows[-1]
+        keys, uscite = sheet.batch_get([f"A{first}:C{last}", f"E{first}:E{last}"])
+        # L'API omette le righe vuote in coda: le uscite mancanti sono vuote.
+        rows = [
+            (key, j < len(uscite) and bool(uscite[j]) and bool(uscite[j][0]))
+            for j, key in enumerate(keys)
+        ]
+    pending = (
+        {k: v for k, v in _today_index.items() if v[0] == _PENDING_ROW}
+        if _today == today else {}
+    )
+    if _today != today:
+        # Nuovo giorno: le chiavi utente parsate si ricostruiscono da quelle di
+        # oggi, così l'indice non cresce con ogni nome visto da quando gira il bot.
+        _USER_INDEX.clear()
+        _pending_expires.clear()
+    _today_index.clear()
+    first = today_rows[0] if today_rows else 0
+    for i, (row, uscita) in enumerate(rows, start=first):
+        # Conta come ingresso solo una riga con l'ora d'ingresso compilata
+        # (righe parziali o modificate a mano restano fuori).
+        if len(row) < 3 or row[0] != today or not row[2]:
+            continue
+        prev = _today_index.get(row[1])
+        # Con più righe nello stesso giorno vale la prima ancora aperta.
+        if prev is None or (prev[1] and not uscita):
+            _today_index[row[1]] = (i, uscita)
+    for key, entry in pending.items():
+        _today_index.setdefault(key, entry)
+    _today = today
+    _today_stale = False
+
+
+def _row_matches(sheet: Worksheet, entry: Tuple[int, bool], today: str, user_id: str) -> bool:
+    i, uscita = entry
+    values = sheet.get(f"A{i}:E{i}")
+    row = values[0] if values else []
+    return (
+        len(row) > 2
+        and row[0] == today
+        and row[1] == user_id
+        and bool(row[2])
+        and (len(row) > 4 and bool(row[4])) == uscita
+    )
+
+
+def _today_entry(sheet: Worksheet, today: str, user_id: str) -> Optional[Tuple[int, bool]]:
+    """Riga di oggi per user_id. Va chiamata tenendo _registro_lock."""
+    expires = _pending_expires.get(user_id)
+    if expires is not None and time.monotonic() >= expires:
+        # L'ingresso con esito ignoto ormai è scritto o perso: decide il foglio.
+        del _pending_expires[user_id]
+        if _today_index.get(user_id) == (_PENDING_ROW, False):
+            del _today_index[user_id]
+        _load_today_index(sheet, today)
+        return _today_index.get(user_id)
+    if _today != today or _today_stale:
+        _load_today_index(sheet, today)
+        return _today_index.get(user_id)
+    entry = _today_index.get(user_id)
+    if entry is not None and entry[0] != _PENDING_ROW and not _row_matches(sheet, entry, today, user_id):
+        logger.info("Indice Registro non allineato per %s, lo ricarico.", user_id)
+        _load_today_index(sheet, today)
+        entry = _today_index.get(user_id)
+    return entry
+
+
+def _appended_row(response: dict) -> Optional[int]:
+    try:
+        match = _APPENDED_ROW_RE.search(response["updates"]["updatedRange"])
+    except (KeyError, TypeError):
+        return None
+    return int(match.group(1)) if match else None
+
+
+async def async_save_ingresso(
+    user: types.User,
+    time_str: str,
+    location_name: str,
+    today: Optional[str] = None,
+) -> bool:
+    today = today or today_str()
+    user_id = _user_key(user)
+    if not await sheets_call(_sync_reserve_ingresso, today, user_id):
+        return False
+    try:
+        row = [today, user_id, time_str, location_name, "", ""]
+        row_index = await queue_append("Registro", row)
+    except asyncio.TimeoutError:
+        # Il thread non si interrompe: l'append può ancora andare a buon fine.
+        await asyncio.to_thread(_sync_ingresso_uncertain, today, user_id)
+        raise
+    except Exception as e:
+        logger.exception("Errore save_ingresso: %s", e)
+        if isinstance(e, gspread.exceptions.APIError) and e.response.status_code < 500:
+            # Rifiuto esplicito di Google: la riga non è stata scritta.
+            await asyncio.to_thread(_sync_settle_ingresso, today, user_id, None, False)
+        else:
+            await asyncio.to_thread(_sync_ingresso_uncertain, today, user_id)
+        return False
+    await asyncio.to_thread(_sync_settle_ingresso, today, user_id, row_index, True, row)
+    try:
+        await sheets_call(upsert_user_notifiche, user.id, user.full_name)
+    except asyncio.TimeoutError:
+        logger.warning("Timeout registrazione notifiche per %s (ingresso salvato).", user_id)
+    return True
+
+def _sync_reserve_ingresso(today: str, user_id: str) -> bool:
     try:
         sheet = get_sheet("Registro")
-        now_local = datetime.now(TIMEZONE)
-        today = now_local.strftime("%d.%m.%Y")
-        user_id = f"{user.full_name} | {user.id}"
-        rows = sheet.get_all_values()
-        for row in rows[1:]:
-            if len(row) > 1 and row[0] == today and row[1] == user_id:
+        with _registro_lock:
+            if _today_entry(sheet, today, user_id) is not None:
                 logger.warning("Ingresso già registrato per %s oggi.", user_id)
                 return False
-        sheet.append_row([today, user_id, time_str, location_name, "", ""])
-        upsert_user_notifiche(user.id, user.full_name)
-        return True
+            _today_index[user_id] = (_PENDING_ROW, False)
+            return True
     except Exception as e:
         logger.exception("Errore save_ingresso: %s", e)
         return False
 
 
-async def async_save_uscita(user: types.User, time_str: str, location_name: str) -> bool:
-    return await sheets_call(_sync_save_uscita, user, time_str, location_name)
+def _registro_written(
+    today: str,
+    user_id: str,
+    i: Optional[int],
+    col: int,
+    values: List[str],
+    uscita: bool,
+) -> None:
+    """Riporta una scrittura riuscita sul Registro nelle cache locali. Con _registro_lock."""
+    global _today_stale, _registro_rows, _registro_version
+    _registro_version += 1
+    if i is None:
+        # Riga scritta ma numero ignoto: indice e copia si ricostruiscono al prossimo uso.
+        _registro_rows = None
+        if _today == today:
+            _today_stale = True
+        return
+    _registro_rows_set(i, col, values)
+    if _today == today:
+        _today_index[user_id] = (i, uscita)
+
 
-def _sync_save_uscita(user: types.User, time_str: str, location_name: str) -> bool:
+def _sync_settle_ingresso(
+    today: str,
+    user_id: str,
+    row_index: Optional[int],
+    ok: bool,
+    row: Optional[List[str]] = None,
+) -> None:
+    with _registro_lock:
+        if not ok:
+            if _today == today and _today_index.get(user_id) == (_PENDING_ROW, False):
+                del _today_index[user_id]
+            return
+        _registro_written(today, user_id, row_index, 1, row or [], uscita=False)
+
+
+def _sync_ingresso_uncertain(today: str, user_id: str) -> None:
+    # La prenotazione resta: un nuovo tentativo non può aggiungere una seconda
+    # riga finché non si sa com'è andata la prima.
+    with _registro_lock:
+        if _today == today and _today_index.get(user_id) == (_PENDING_ROW, False):
+            _pending_expires[user_id] = time.monotonic() + _UNCERTAIN_TTL
+
+
+def _sync_prewarm_today_index(today: str) -> None:
+    # Costruisce l'indice prima del primo ingresso del giorno, così il primo
+    # utente non paga la lettura della colonna A.
+    sheet = get_sheet("Registro")
+    with _registro_lock:
+        if _today != today or _today_stale:
+            _load_today_index(sheet, today)
+
+
+def _sync_today_presence(today: str) -> Tuple[set, set]:
+    """Id Telegram di chi oggi ha un ingresso e di chi ha già registrato l'uscita."""
+    sheet = get_sheet("Registro")
+    with _registro_lock:
+        # Ricarica solo le righe di oggi, aggiornando anche l'indice.
+        _load_today_index(sheet, today)
+        entered_ids: set = set()
+        exited_ids: set = set()
+        for key, (_, uscita) in _today_index.items():
+            parsed = _parse_user_key(key)
+            if not parsed:
+                continue
+            entered_ids.add(parsed[1])
+            if uscita:
+                exited_ids.add(parsed[1])
+    return entered_ids, exited_ids
+
+
+async def async_save_uscita(
+    user: types.User,
+    time_str: str,
+    location_name: str,
+    today: Optional[str] = None,
+) -> bool:
+    return await sheets_call(_sync_save_uscita, user, time_str, location_name, today)
+
+def _sync_save_uscita(
+    user: types.User,
+    time_str: str,
+    location_name: str,
+    today: Optional[str] = None,
+) -> bool:
     try:
         sheet = get_sheet("Registro")
-        now_local = datetime.now(TIMEZONE)
-        today = now_local.strftime("%d.%m.%Y")
-        user_id = f"{user.full_name} | {user.id}"
-        rows = sheet.get_all_values()
-        for i, row in enumerate(rows[1:], start=2):
-            if len(row) > 4 and row[0] == today and row[1] == user_id and not row[4]:
-                col_e = gspread.utils.rowcol_to_a1(i, 5)
-                col_f = gspread.utils.rowcol_to_a1(i, 6)
-                sheet.batch_update([{
-                    'range': f'{col_e}:{col_f}',
-                    'values': [[time_str, location_name]]
-                }])
-                return True
-        logger.warning("Nessun ingresso trovato per %s oggi.", user_id)
-        return False
+        today = today or today_str()
+        user_id = _user_key(user)
+        with _registro_lock:
+            entry = _today_entry(sheet, today, user_id)
+            if entry is None or entry[0] == _PENDING_ROW or entry[1]:
+                logger.warning("Nessun ingresso trovato per %s oggi.", user_id)
+                return False
+            i = entry[0]
+        # Scrittura fuori dal lock: con i ritentativi può durare, e ingressi e
+        # scheduler non devono aspettarla.
+        # Uscita ora + posizione in un'unica values:update, RAW come gli append.
+        _retry(
+            sheet.update,
+            values=[[time_str, location_name]],
+            range_name=f"E{i}:F{i}",
+            value_input_option="RAW",
+        )
+        with _registro_lock:
+            _registro_written(today, user_id, i, 5, [time_str, location_name], uscita=True)
+        return True
     except Exception as e:
         logger.exception("Errore save_uscita: %s", e)
         return False
 
 
-async def async_save_permesso(user: types.User, start_date: str, end_date: str, reason: str) -> bool:
-    return await sheets_call(_sync_save_permesso, user, start_date, end_date, reason)
+_ISO_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
 
-def _sync_save_permesso(user: types.User, start_date: str, end_date: str, reason: str) -> bool:
+
+async def async_save_permesso(user: types.User, start_date: str, end_date: str, reason: str) -> bool:
     try:
-        start_dt = datetime.strptime(start_date, "%Y-%m-%d")
-        end_dt = datetime.strptime(end_date, "%Y-%m-%d")
-        if end_dt < start_dt:
+        # Date YYYY-MM-DD: il confronto tra stringhe equivale a quello tra date.
+        if not (_ISO_DATE_RE.fullmatch(start_date) and _ISO_DATE_RE.fullmatch(end_date)):
+            return False
+        if end_date < start_date:
             return False
-        sheet = get_sheet("Permessi")
         now_local = datetime.now(TIMEZONE)
-        created = now_local.strftime("%d.%m.%Y %H:%M")
-        user_id = f"{user.full_name} | {user.id}"
-        sheet.append_row([created, user_id, start_date, end_date, reason])
+        created = f"{today_str(now_local)} {hhmm_str(now_local)}"
+        user_id = _user_key(user)
+        await queue_append("Permessi", [created, user_id, start_date, end_date, reason])
         return True
+    except asyncio.TimeoutError:
+        raise
     except Exception as e:
         logger.exception("Errore save_permesso: %s", e)
         return False
 
 
-async def get_riepilogo(user: types.User, year: int, month: int) -> Optional[io.StringIO]:
+async def get_riepilogo(user: types.User, year: int, month: int) -> Optional[io.BytesIO]:
     return await sheets_call(_sync_get_riepilogo, user, year, month)
 
-def _sync_get_riepilogo(user: types.User, year: int, month: int) -> Optional[io.StringIO]:
+_RIEPILOGO_HEADER = b"Data,Utente,Ingresso ora,Posizione ingresso,Uscita ora,Posizione uscita\r\n"
+# Caratteri che obbligano csv.writer a mettere il campo tra virgolette
+_CSV_SPECIAL_RE = re.compile(r'[,"\r\n]')
+
+
+def _fetch_riepilogo_rows(sheet: Worksheet, user_id: str, month_filter: str) -> List[List[str]]:
+    # Senza copia locale: colonne A:B per trovare le righe del mese, poi solo
+    # quelle righe (A:F) in un'unica batch_get.
+    keys = sheet.get("A2:B")
+    indexes = [
+        i for i, row in enumerate(keys, start=2)
+        if len(row) > 1 and row[1] == user_id and row[0][3:10] == month_filter
+    ]
+    if not indexes:
+        return []
+    # L'API tronca le celle vuote in coda: si riportano le righe a 6 colonne.
+    return [
+        value_range[0] + [""] * (6 - len(value_range[0]))
+        for value_range in sheet.batch_get([f"A{i}:F{i}" for i in indexes])
+        if value_range
+    ]
+
+
+def _sync_get_riepilogo(user: types.User, year: int, month: int) -> Optional[io.BytesIO]:
     try:
-        sheet = get_sheet("Registro")
-        rows = sheet.get_all_values()
-        user_id = f"{user.full_name} | {user.id}"
+        user_id = _user_key(user)
         month_filter = f"{month:02d}.{year}"
-        user_rows = [
-            row for row in rows[1:]
-            if len(row) > 1
-            and row[1] == user_id
-            and len(row[0]) >= 7
-            and row[0][3:10] == month_filter
-        ]
+        _refresh_registro_rows()
+        with _registro_lock:
+            rows = _registro_rows
+            if rows is not None:
+                user_rows = [
+                    list(row) for row in rows
+                    if len(row) > 1
+                    and row[1] == user_id
+                    and len(row[0]) >= 7
+                    and row[0][3:10] == month_filter
+                ]
+        if rows is None:
+            user_rows = _fetch_riepilogo_rows(get_sheet("Registro"), user_id, month_filter)
         if not user_rows:
             return None
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerow(["Data", "Utente", "Ingresso ora", "Posizione ingresso", "Uscita ora", "Posizione uscita"])
-        writer.writerows(user_rows)
-        output.seek(0)
+        output = io.BytesIO()
+        output.write(_RIEPILOGO_HEADER)
+        if not _CSV_SPECIAL_RE.search("".join(field for row in user_rows for field in row)):
+            # Nessun campo da quotare: stesso output di csv.writer, con un solo join.
+            output.write("\r\n".join(map(",".join, user_rows)).encode("utf-8"))
+            output.write(b"\r\n")
+            return output
+        # Il CSV viene codificato in UTF-8 direttamente nel buffer di byte.
+        text = io.TextIOWrapper(output, encoding="utf-8", newline="", write_through=True)
+        csv.writer(text).writerows(user_rows)
+        text.detach()  # altrimenti chiudendo il wrapper si chiude anche output
         return output
     except Exception as e:
         logger.exception("Errore get_riepilogo: %s", e)
@@ -333,8 +1029,9 @@ async def async_save_lavoro(
     numero_bus: str,
     tipo: str,
     note: str,
+    timeout: float = 12.0,
 ) -> bool:
-    return await sheets_call(_sync_save_lavoro, user, numero_bus, tipo, note)
+    return await sheets_call(_sync_save_lavoro, user, numero_bus, tipo, note, timeout=timeout)
 
 
 def _sync_save_lavoro(
@@ -350,10 +1047,10 @@ def _sync_save_lavoro(
     try:
         sheet = get_sheet("Produttività")
         now_local = datetime.now(TIMEZONE)
-        today = now_local.strftime("%d.%m.%Y")
-        ora = now_local.strftime("%H:%M")
-        user_id = f"{user.full_name} | {user.id}"
-        sheet.append_row([today, ora, user_id, numero_bus, tipo, note])
+        today = today_str(now_local)
+        ora = hhmm_str(now_local)
+        user_id = _user_key(user)
+        _append_row(sheet, [today, ora, user_id, numero_bus, tipo, note])
         return True
     except Exception as e:
         logger.exception("Errore save_lavoro: %s", e)
@@ -366,7 +1063,7 @@ def _sync_get_lavori_mese(user_id_str: str, year: int, month: int) -> List[dict]
         rows = sheet.get_all_values()
         month_filter = f"{month:02d}.{year}"
         result = []
-        for row in rows[1:]:
+        for row in islice(rows, 1, None):
             if len(row) < 5:
                 continue
             if row[2] != user_id_str:
@@ -391,7 +1088,7 @@ def _sync_get_lavori_giorno(user_id_str: str, giorno: str) -> List[dict]:
         sheet = get_sheet("Produttività")
         rows = sheet.get_all_values()
         result = []
-        for row in rows[1:]:
+        for row in islice(rows, 1, None):
             if len(row) < 5:
                 continue
             if row[0] != giorno or row[2] != user_id_str:
@@ -428,7 +1125,7 @@ def _sync_get_appunti(user_id: int) -> List[dict]:
         sheet = get_sheet("Appunti")
         rows = sheet.get_all_values()
         result = []
-        for i, row in enumerate(rows[1:], start=2):
+        for i, row in enumerate(islice(rows, 1, None), start=2):
             if len(row) < 3:
                 continue
             if row[1].strip() != str(user_id):
@@ -450,13 +1147,14 @@ def _sync_add_appunto(user_id: int, testo: str) -> bool:
         sheet = get_sheet("Appunti")
         rows = sheet.get_all_values()
         ids_utente = [
-            int(r[0]) for r in rows[1:]
+            int(r[0]) for r in islice(rows, 1, None)
             if len(r) >= 2 and r[1].strip() == str(user_id)
             and r[0].strip().isdigit()
         ]
         next_id = (max(ids_utente) + 1) if ids_utente else 1
-        now_local = datetime.now(TIMEZONE).strftime("%d.%m.%Y %H:%M")
-        sheet.append_row([str(next_id), str(user_id), testo, now_local])
+        now_local = datetime.now(TIMEZONE)
+        created = f"{today_str(now_local)} {hhmm_str(now_local)}"
+        _append_row(sheet, [str(next_id), str(user_id), testo, created])
         return True
     except Exception as e:
         logger.exception("Errore add_appunto: %s", e)
@@ -639,47 +1337,75 @@ def _setup_produttivita_formatting(sheet_prod: Worksheet) -> None:
         logger.warning("Formattazione Produttività non applicata (non bloccante): %s", e)
 
 
+SHEET_HEADERS: Dict[str, List[str]] = {
+    "Registro": ["Data", "Utente", "Ingresso ora", "Posizione ingresso", "Uscita ora", "Posizione uscita"],
+    "Permessi": ["Data richiesta", "Utente", "Dal", "Al", "Motivo"],
+    "ZoneLavoro": ["Nome", "Latitudine", "Longitudine"],
+    "Notifiche": [
+        "Telegram ID", "Nome",
+        "Reminder Ingresso", "Orario Ingresso",
+        "Reminder Uscita", "Orario Uscita"
+    ],
+    "Produttività": ["Data", "Ora", "Utente", "N° Bus", "Tipo Lavoro", "Note"],
+    "Appunti": ["ID", "Telegram ID", "Testo", "Data creazione"],
+}
+# Fogli senza i quali il bot non può funzionare: se mancano init_sheets fallisce.
+_REQUIRED_SHEETS = ("Registro", "Permessi")
+
+
+def _prime_sheets_cache() -> Dict[str, Worksheet]:
+    # Una sola chiamata di metadati apre tutti i fogli e riempie la cache
+    # degli handle, invece di una worksheet() per foglio.
+    _invalidate_sheets_cache()
+    worksheets = {ws.title: ws for ws in _get_spreadsheet().worksheets()}
+    _sheets_cache.update(worksheets)
+    return worksheets
+
+
 def init_sheets() -> None:
     try:
-        sheet_reg = get_sheet("Registro")
-        if not sheet_reg.row_values(1):
-            sheet_reg.append_row(["Data", "Utente", "Ingresso ora", "Posizione ingresso", "Uscita ora", "Posizione uscita"])
-        sheet_perm = get_sheet("Permessi")
-        if not sheet_perm.row_values(1):
-            sheet_perm.append_row(["Data richiesta", "Utente", "Dal", "Al", "Motivo"])
-        try:
-            sheet_zone = get_sheet("ZoneLavoro")
-            if not sheet_zone.row_values(1):
-                sheet_zone.append_row(["Nome", "Latitudine", "Longitudine"])
-        except Exception:
-            pass
-        try:
-            sheet_notif = get_sheet("Notifiche")
-            if not sheet_notif.row_values(1):
-                sheet_notif.append_row([
-                    "Telegram ID", "Nome",
-                    "Reminder Ingresso", "Orario Ingresso",
-                    "Reminder Uscita", "Orario Uscita"
-                ])
-        except Exception:
-            pass
-        try:
-            sheet_prod = get_sheet("Produttività")
-            if not sheet_prod.row_values(1):
-                sheet_prod.append_row(
-                    ["Data", "Ora", "Utente", "N° Bus", "Tipo Lavoro", "Note"]
-                )
-                _setup_produttivita_formatting(sheet_prod)
-        except Exception as e:
-            logger.warning("Produttività sheet init warning: %s", e)
+        worksheets = _prime_sheets_cache()
+        for name in _REQUIRED_SHEETS:
+            if name not in worksheets:
+                raise gspread.exceptions.WorksheetNotFound(name)
+
+        # Prima riga di tutti i fogli con un'unica values:batchGet.
+        names = [name for name in SHEET_HEADERS if name in worksheets]
+        response = _get_spreadsheet().values_batch_get([f"'{name}'!1:1" for name in names])
+        first_rows = {
+            name: value_range.get("values")
+            for name, value_range in zip(names, response.get("valueRanges", []))
+        }
+
+        # Intestazioni mancanti scritte in riga 1 con un'unica values:batchUpdate.
+        missing = [name for name in names if not first_rows.get(name)]
+        if missing:
+            _get_spreadsheet().values_batch_update({
+                "valueInputOption": "RAW",
+                "data": [
+                    {
+                        "range": f"'{name}'!A1:{gspread.utils.rowcol_to_a1(1, len(SHEET_HEADERS[name]))}",
+                        "values": [SHEET_HEADERS[name]],
+                    }
+                    for name in missing
+                ],
+            })
+            logger.info("Intestazioni create: %s", ", ".join(missing))
+        for name in missing:
+            try:
+                if name == "Produttività":
+                    _setup_produttivita_formatting(worksheets[name])
+                elif name == "Appunti":
+                    _setup_appunti_formatting(worksheets[name])
+            except Exception as e:
+                logger.warning("%s sheet init warning: %s", name, e)
 
         try:
-            sheet_app = get_sheet("Appunti")
-            if not sheet_app.row_values(1):
-                sheet_app.append_row(["ID", "Telegram ID", "Testo", "Data creazione"])
-                _setup_appunti_formatting(sheet_app)
+            rows = _download_registro_rows(worksheets["Registro"])
+            with _registro_lock:
+                _install_registro_rows(rows)
         except Exception as e:
-            logger.warning("Appunti sheet init warning: %s", e)
+            logger.warning("Copia locale del Registro non caricata: %s", e)
 
         logger.info("Sheets inizializzati.")
     except Exception as e:
@@ -689,13 +1415,28 @@ def init_sheets() -> None:
 # ============================================================
 # Notifiche sheet helpers
 # ============================================================
+# Orari "HH:MM" sempre a due cifre: lo scheduler li confronta come stringhe.
+_ORARIO_RE = re.compile(r"([01]\d|2[0-3]):[0-5]\d")
+
+
+def _parse_orario(value: str, default: str, row_index: int) -> str:
+    # Il foglio si può modificare a mano: un orario non valido ("7:30", "8.30")
+    # romperebbe confronti e calcolo della sveglia, si usa quello predefinito.
+    value = value.strip()
+    if not value:
+        return default
+    if _ORARIO_RE.fullmatch(value):
+        return value
+    logger.warning("Notifiche riga %s: orario '%s' non valido, uso %s", row_index, value, default)
+    return default
+
 
 def get_notifiche_settings() -> Dict[int, dict]:
     try:
         sheet = get_sheet("Notifiche")
         rows = sheet.get_all_values()
         result: Dict[int, dict] = {}
-        for i, row in enumerate(rows[1:], start=2):
+        for i, row in enumerate(islice(rows, 1, None), start=2):
             if len(row) < 6 or not row[0].strip():
                 continue
             try:
@@ -705,9 +1446,9 @@ def get_notifiche_settings() -> Dict[int, dict]:
             result[uid] = {
                 "nome": row[1],
                 "reminder_ingresso": row[2].strip().upper() == "TRUE",
-                "orario_ingresso": row[3].strip() or "08:00",
+                "orario_ingresso": _parse_orario(row[3], "08:00", i),
                 "reminder_uscita": row[4].strip().upper() == "TRUE",
-                "orario_uscita": row[5].strip() or "17:00",
+                "orario_uscita": _parse_orario(row[5], "17:00", i),
                 "row_index": i,
             }
         return result
@@ -721,11 +1462,9 @@ def upsert_user_notifiche(user_id: int, nome: str,
                            reminder_out: bool = True, orario_out: str = "17:00") -> bool:
     try:
         sheet = get_sheet("Notifiche")
-        rows = sheet.get_all_values()
-        for row in rows[1:]:
-            if row and row[0].strip() == str(user_id):
-                return True
-        sheet.append_row([
+        if _find_row(sheet, str(user_id)) is not None:
+            return True
+        _append_row(sheet, [
             str(user_id), nome,
             "TRUE" if reminder_in else "FALSE", orario_in,
             "TRUE" if reminder_out else "FALSE", orario_out,
@@ -740,10 +1479,12 @@ def toggle_notifica(user_id: int, tipo: str) -> Optional[bool]:
     col = 3 if tipo == "in" else 5
     try:
         sheet = get_sheet("Notifiche")
-        rows = sheet.get_all_values()
-        for i, row in enumerate(rows[1:], start=2):
+        letter = gspread.utils.rowcol_to_a1(1, col)[:-1]
+        ids, values = sheet.batch_get(["A2:A", f"{letter}2:{letter}"])
+        for i, row in enumerate(ids, start=2):
             if row and row[0].strip() == str(user_id):
-                current = row[col - 1].strip().upper() == "TRUE"
+                cell = values[i - 2] if i - 2 < len(values) else []
+                current = bool(cell) and cell[0].strip().upper() == "TRUE"
                 new_val = not current
                 sheet.update_cell(i, col, "TRUE" if new_val else "FALSE")
                 _invalidate_notifiche_cache()
@@ -758,13 +1499,12 @@ def set_orario_notifica(user_id: int, tipo: str, orario: str) -> bool:
     col = 4 if tipo == "in" else 6
     try:
         sheet = get_sheet("Notifiche")
-        rows = sheet.get_all_values()
-        for i, row in enumerate(rows[1:], start=2):
-            if row and row[0].strip() == str(user_id):
-                sheet.update_cell(i, col, orario)
-                _invalidate_notifiche_cache()
-                return True
-        return False
+        i = _find_row(sheet, str(user_id))
+        if i is None:
+            return False
+        sheet.update_cell(i, col, orario)
+        _invalidate_notifiche_cache()
+        return True
     except Exception as e:
         logger.exception("Errore set_orario_notifica: %s", e)
         return False
@@ -773,19 +1513,36 @@ def set_orario_notifica(user_id: int, tipo: str, orario: str) -> bool:
 # ============================================================
 # Location utils
 # ============================================================
-def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-    R = 6371000
-    dlat, dlon = radians(lat2 - lat1), radians(lon2 - lon1)
-    a = sin(dlat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2) ** 2
-    return R * 2 * atan2(sqrt(a), sqrt(1 - a))
-
-
 def check_location(lat: float, lon: float) -> Optional[str]:
     work_locations = get_work_locations()
-    for name, (wlat, wlon) in work_locations.items():
-        if haversine(lat, lon, wlat, wlon) <= MAX_DISTANCE_METERS:
-            return name
-    return None
+    zones = (
+        _work_locations_rad if work_locations is _work_locations_cache
+        else _locations_to_rad(work_locations)
+    )
+    # Haversine esatto, ma confrontato sul termine "a" (monotono nella distanza):
+    # niente sqrt né atan2 per zona.
+    lat_r, lon_r = radians(lat), radians(lon)
+    cos_lat = cos(lat_r)
+    # Zone ordinate per latitudine: si guardano solo quelle nella fascia di ±200 m,
+    # e se più zone sono in raggio vince la più vicina.
+    best, best_a = None, _HAVERSINE_A_MAX
+    start = bisect.bisect_left(zones, lat_r - _MAX_DISTANCE_RAD, key=_zone_lat)
+    for name, wlat_r, wlon_r, cos_wlat, lon_delta in islice(zones, start, None):
+        dlat = lat_r - wlat_r
+        if dlat < -_MAX_DISTANCE_RAD:
+            break
+        dlon = lon_r - wlon_r
+        # Fuori dal riquadro di ±200 m la zona non può essere quella giusta
+        if abs(dlon) > lon_delta:
+            continue
+        s_lat, s_lon = sin(dlat / 2), sin(dlon / 2)
+        a = s_lat * s_lat + cos_lat * cos_wlat * s_lon * s_lon
+        if a <= best_a:
+            best, best_a = name, a
+    if best is not None and logger.isEnabledFor(logging.DEBUG):
+        distance = EARTH_RADIUS_METERS * 2 * atan2(sqrt(best_a), sqrt(1 - best_a))
+        logger.debug("Posizione in zona '%s' (%.0f m)", best, distance)
+    return best
 
 
 # ============================================================
@@ -811,6 +1568,21 @@ location_kb = ReplyKeyboardMarkup(
     resize_keyboard=True,
 )
 
+remove_kb = types.ReplyKeyboardRemove()
+
+
+# ============================================================
+# Callback data
+# ============================================================
+class PermCB(CallbackData, prefix="perm"):
+    # Stesso formato di prima ("perm:start:day:2026:10:5"), quindi i calendari
+    # già inviati continuano a funzionare. value = giorno oppure prev/next.
+    phase: str
+    kind: str
+    year: int
+    month: int
+    value: str
+
 
 # ============================================================
 # FSM States
@@ -847,39 +1619,57 @@ class NotificheForm(StatesGroup):
 # ============================================================
 # Calendar builder (permessi)
 # ============================================================
+_MESI = ("Gennaio", "Febbraio", "Marzo", "Aprile", "Maggio", "Giugno",
+         "Luglio", "Agosto", "Settembre", "Ottobre", "Novembre", "Dicembre")
+
+
 def mese_nome(month: int) -> str:
-    mesi = ["Gennaio", "Febbraio", "Marzo", "Aprile", "Maggio", "Giugno",
-            "Luglio", "Agosto", "Settembre", "Ottobre", "Novembre", "Dicembre"]
-    return mesi[month - 1]
+    return _MESI[month - 1]
+
+
+_GIORNI_SETTIMANA = ("Lu", "Ma", "Me", "Gi", "Ve", "Sa", "Do")
+
+
+@functools.lru_cache(maxsize=256)
+def _calendar_layout(year: int, month: int) -> Tuple[Tuple[int, ...], ...]:
+    # Settimane del mese sempre su 6 righe (0 = cella vuota), condivise dai
+    # due calendari: la tastiera non cambia altezza passando da un mese all'altro.
+    weeks = [tuple(week) for week in calendar.monthcalendar(year, month)]
+    while len(weeks) < 6:
+        weeks.append((0,) * 7)
+    return tuple(weeks)
+
 
+def build_calendar(year: int, month: int, phase: str, today: Optional[datetime] = None):
+    if today is None:
+        today = datetime.now(TIMEZONE)
+    # Il giorno evidenziato conta solo nel mese corrente: negli altri la chiave è 0.
+    today_day = today.day if (today.year, today.month) == (year, month) else 0
+    return _build_calendar(year, month, phase, today_day)
 
-def build_calendar(year: int, month: int, phase: str):
+
+@functools.lru_cache(maxsize=128)
+def _build_calendar(year: int, month: int, phase: str, today_day: int) -> types.InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
-    today = datetime.now(TIMEZONE)
-    giorni = ["Lu", "Ma", "Me", "Gi", "Ve", "Sa", "Do"]
 
     kb.button(text=f"{mese_nome(month)} {year}", callback_data="ignore")
-    for g in giorni:
+    for g in _GIORNI_SETTIMANA:
         kb.button(text=g, callback_data="ignore")
 
-    weeks = calendar.monthcalendar(year, month)
-    while len(weeks) < 6:
-        weeks.append([0] * 7)
-
+    weeks = _calendar_layout(year, month)
     for week in weeks:
         for day in week:
             if day == 0:
                 kb.button(text=" ", callback_data="ignore")
             else:
-                text_day = (
-                    f"🔵{day}"
-                    if (day == today.day and month == today.month and year == today.year)
-                    else str(day)
+                text_day = f"🔵{day}" if day == today_day else str(day)
+                kb.button(
+                    text=text_day,
+                    callback_data=PermCB(phase=phase, kind="day", year=year, month=month, value=str(day)),
                 )
-                kb.button(text=text_day, callback_data=f"perm:{phase}:day:{year}:{month}:{day}")
 
-    kb.button(text="◀️", callback_data=f"perm:{phase}:nav:{year}:{month}:prev")
-    kb.button(text="▶️", callback_data=f"perm:{phase}:nav:{year}:{month}:next")
+    kb.button(text="◀️", callback_data=PermCB(phase=phase, kind="nav", year=year, month=month, value="prev"))
+    kb.button(text="▶️", callback_data=PermCB(phase=phase, kind="nav", year=year, month=month, value="next"))
     kb.adjust(1, 7, *([7] * len(weeks)), 2)
     return kb.as_markup()
 
@@ -891,34 +1681,44 @@ def build_lavori_calendar(
     year: int,
     month: int,
     giorni_con_lavori: set,
+    today: Optional[datetime] = None,
+) -> types.InlineKeyboardMarkup:
+    if today is None:
+        today = datetime.now(TIMEZONE)
+    today_day = today.day if (today.year, today.month) == (year, month) else 0
+    # Nella chiave della cache entrano solo i giorni con lavori di questo mese.
+    suffix = f".{month:02d}.{year}"
+    giorni = frozenset(
+        int(giorno[:2]) for giorno in giorni_con_lavori
+        if len(giorno) == 10 and giorno.endswith(suffix) and giorno[:2].isdigit()
+    )
+    return _build_lavori_calendar(year, month, giorni, today_day)
+
+
+@functools.lru_cache(maxsize=128)
+def _build_lavori_calendar(
+    year: int,
+    month: int,
+    giorni_con_lavori: frozenset,
+    today_day: int,
 ) -> types.InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
-    today = datetime.now(TIMEZONE)
-    nomi_giorni = ["Lu", "Ma", "Me", "Gi", "Ve", "Sa", "Do"]
 
     kb.button(
         text=f"📆 {mese_nome(month)} {year}",
         callback_data="cal_lavori:ignore"
     )
-    for g in nomi_giorni:
+    for g in _GIORNI_SETTIMANA:
         kb.button(text=g, callback_data="cal_lavori:ignore")
 
-    weeks = calendar.monthcalendar(year, month)
-    while len(weeks) < 6:
-        weeks.append([0] * 7)
-
+    weeks = _calendar_layout(year, month)
     for week in weeks:
         for day in week:
             if day == 0:
                 kb.button(text=" ", callback_data="cal_lavori:ignore")
             else:
-                giorno_str = f"{day:02d}.{month:02d}.{year}"
-                ha_lavori = giorno_str in giorni_con_lavori
-                is_today = (
-                    day == today.day
-                    and month == today.month
-                    and year == today.year
-                )
+                ha_lavori = day in giorni_con_lavori
+                is_today = day == today_day
                 if ha_lavori and is_today:
                     label = f"✅{day}◉"
                 elif ha_lavori:
@@ -1002,9 +1802,10 @@ async def ingresso_location(message: Message, state: FSMContext):
     if not location_name:
         await message.answer("❌ Non sei in un luogo autorizzato.", reply_markup=main_kb)
         return
-    now_local = datetime.now(TIMEZONE).strftime("%H:%M")
+    # Data e ora dallo stesso istante: niente sfasamenti a cavallo della mezzanotte.
+    now = datetime.now(TIMEZONE)
     try:
-        if await async_save_ingresso(message.from_user, now_local, location_name):
+        if await async_save_ingresso(message.from_user, hhmm_str(now), location_name, today_str(now)):
             await message.answer("✅ Ingresso registrato!", reply_markup=main_kb)
         else:
             await message.answer("❌ Ingresso già registrato per oggi.", reply_markup=main_kb)
@@ -1030,9 +1831,9 @@ async def uscita_location(message: Message, state: FSMContext):
     if not location_name:
         await message.answer("❌ Non sei in un luogo autorizzato.", reply_markup=main_kb)
         return
-    now_local = datetime.now(TIMEZONE).strftime("%H:%M")
+    now = datetime.now(TIMEZONE)
     try:
-        if await async_save_uscita(message.from_user, now_local, location_name):
+        if await async_save_uscita(message.from_user, hhmm_str(now), location_name, today_str(now)):
             await message.answer("✅ Uscita registrata!", reply_markup=main_kb)
         else:
             await message.answer("❌ Nessun ingresso trovato per oggi.", reply_markup=main_kb)
@@ -1047,20 +1848,16 @@ async def uscita_location(message: Message, state: FSMContext):
 async def permessi_start(message: Message, state: FSMContext):
     await state.set_state(PermessiForm.waiting_for_start)
     now = datetime.now(TIMEZONE)
-    await message.answer("📅 Seleziona data di inizio:", reply_markup=build_calendar(now.year, now.month, "start"))
+    await message.answer("📅 Seleziona data di inizio:", reply_markup=build_calendar(now.year, now.month, "start", now))
 
 
-@dp.callback_query(F.data.startswith("perm:"))
-async def perm_calendar_handler(cb: CallbackQuery, state: FSMContext):
-    parts = cb.data.split(":")
-    if len(parts) < 3:
-        await cb.answer()
-        return
-    phase, kind = parts[1], parts[2]
+@dp.callback_query(PermCB.filter())
+async def perm_calendar_handler(cb: CallbackQuery, callback_data: PermCB, state: FSMContext):
+    phase, kind = callback_data.phase, callback_data.kind
+    year, month = callback_data.year, callback_data.month
 
     if kind == "nav":
-        year, month, direction = int(parts[3]), int(parts[4]), parts[5]
-        if direction == "prev":
+        if callback_data.value == "prev":
             month, year = (12, year - 1) if month == 1 else (month - 1, year)
         else:
             month, year = (1, year + 1) if month == 12 else (month + 1, year)
@@ -1069,7 +1866,7 @@ async def perm_calendar_handler(cb: CallbackQuery, state: FSMContext):
         return
 
     if kind == "day":
-        year, month, day = int(parts[3]), int(parts[4]), int(parts[5])
+        day = int(callback_data.value)
         selected = f"{year}-{month:02d}-{day:02d}"
         if phase == "start":
             await state.update_data(start_date=selected)
@@ -1108,6 +1905,9 @@ async def permessi_reason(message: Message, state: FSMContext):
 # ============================================================
 # Handlers – Riepilogo
 # ============================================================
+# Oltre questa soglia il CSV viene inviato compresso (.csv.gz); sotto non
+# conviene, un mese tipico pesa pochi KB e il .csv si apre direttamente.
+_RIEPILOGO_GZIP_MIN_BYTES = 64 * 1024
 
 def _build_year_keyboard() -> types.InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
@@ -1179,8 +1979,11 @@ async def riepilogo_month_handler(cb: CallbackQuery):
         )
         return
 
-    csv_bytes = riepilogo.getvalue().encode("utf-8")
+    csv_bytes = riepilogo.getvalue()
     filename = f"riepilogo_{year}_{month:02d}.csv"
+    if len(csv_bytes) >= _RIEPILOGO_GZIP_MIN_BYTES:
+        csv_bytes = gzip.compress(csv_bytes)
+        filename += ".gz"
     input_file = BufferedInputFile(csv_bytes, filename=filename)
 
     try:
@@ -1207,6 +2010,9 @@ def _build_tipo_lavoro_kb() -> types.InlineKeyboardMarkup:
     return kb.as_markup()
 
 
+tipo_lavoro_kb = _build_tipo_lavoro_kb()
+
+
 # FIX 2: usa il row index come riferimento nel callback_data invece del testo
 # (il testo può superare il limite di 64 byte di Telegram con caratteri UTF-8)
 def _build_note_kb(appunti: List[dict]) -> types.InlineKeyboardMarkup:
@@ -1231,7 +2037,7 @@ async def lavoro_start(message: Message, state: FSMContext):
     await message.answer(
         "🚌 <b>Registrazione Lavoro</b>\n\n"
         "Inserisci il <b>numero del bus</b> su cui hai lavorato:",
-        reply_markup=types.ReplyKeyboardRemove(),
+        reply_markup=remove_kb,
     )
 
 
@@ -1246,7 +2052,7 @@ async def lavoro_bus(message: Message, state: FSMContext):
     await message.answer(
         f"✅ Bus: <b>{numero_bus}</b>\n\n"
         "Seleziona il <b>tipo di lavoro</b> svolto:",
-        reply_markup=_build_tipo_lavoro_kb(),
+        reply_markup=tipo_lavoro_kb,
     )
 
 
@@ -1361,10 +2167,7 @@ async def _salva_lavoro(
 
     ok = False
     try:
-        ok = await asyncio.wait_for(
-            asyncio.to_thread(_sync_save_lavoro, user, numero_bus, tipo, note),
-            timeout=12.0,
-        )
+        ok = await async_save_lavoro(user, numero_bus, tipo, note)
     except asyncio.TimeoutError:
         logger.error("_salva_lavoro: timeout per user %s", user.id)
         await _send("⚠️ Il server è lento. Riprova.", reply_markup=main_kb)
@@ -1404,10 +2207,7 @@ async def testlavoro_handler(message: Message):
         return
     await message.answer("⏳ Test salvataggio su foglio Produttività…")
     try:
-        ok = await asyncio.wait_for(
-            asyncio.to_thread(_sync_save_lavoro, message.from_user, "TEST-99", "Test", "Riga di test /testlavoro"),
-            timeout=12.0,
-        )
+        ok = await async_save_lavoro(message.from_user, "TEST-99", "Test", "Riga di test /testlavoro")
         if ok:
             await message.answer("✅ Salvataggio riuscito! Controlla il foglio Produttività.", reply_markup=main_kb)
         else:
@@ -1679,11 +2479,35 @@ async def appunto_confirm_delete_handler(cb: CallbackQuery):
 # Handlers – Calendario Lavori
 # ============================================================
 
+def _lavori_month_text(year: int, month: int, totale: int) -> str:
+    return (
+        f"📆 <b>Calendario Lavori — {mese_nome(month)} {year}</b>\n\n"
+        f"✅ = giorno con registrazioni  🔵 = oggi\n\n"
+        f"Lavori registrati questo mese: <b>{totale}</b>\n"
+        "Tocca un giorno evidenziato per vedere il dettaglio."
+    )
+
+
+async def _edit_lavori_month(cb: CallbackQuery, user_id_str: str, year: int, month: int) -> None:
+    await cb.answer(f"⏳ Carico {mese_nome(month)} {year}…")
+
+    try:
+        lavori = await async_get_lavori_mese(user_id_str, year, month)
+    except asyncio.TimeoutError:
+        await cb.answer("⚠️ Timeout, riprova.", show_alert=True)
+        return
+
+    await cb.message.edit_text(
+        _lavori_month_text(year, month, len(lavori)),
+        reply_markup=build_lavori_calendar(year, month, {r["data"] for r in lavori}),
+    )
+
+
 @dp.message(F.text == "📆 Calendario Lavori")
 async def calendario_lavori_start(message: Message):
     now = datetime.now(TIMEZONE)
     year, month = now.year, now.month
-    user_id_str = f"{message.from_user.full_name} | {message.from_user.id}"
+    user_id_str = _user_key(message.from_user)
 
     await message.answer("⏳ Carico il calendario…", reply_markup=main_kb)
 
@@ -1694,65 +2518,45 @@ async def calendario_lavori_start(message: Message):
         return
 
     giorni_con_lavori = {r["data"] for r in lavori}
-    totale = len(lavori)
-
-    testo = (
-        f"📆 <b>Calendario Lavori — {mese_nome(month)} {year}</b>\n\n"
-        f"✅ = giorno con registrazioni  🔵 = oggi\n\n"
-        f"Lavori registrati questo mese: <b>{totale}</b>\n"
-        "Tocca un giorno evidenziato per vedere il dettaglio."
-    )
 
     await message.answer(
-        testo,
-        reply_markup=build_lavori_calendar(year, month, giorni_con_lavori),
+        _lavori_month_text(year, month, len(lavori)),
+        reply_markup=build_lavori_calendar(year, month, giorni_con_lavori, now),
     )
 
 
+# cal_lavori:ignore | nav:Y:M:prev|next | day:Y:M:D | back:Y:M — un solo match
+# al posto di split e indici, e i payload malformati si scartano subito.
+_CAL_LAVORI_RE = re.compile(
+    r"cal_lavori:(?:ignore"
+    r"|nav:(?P<ny>\d{4}):(?P<nm>\d{1,2}):(?P<dir>prev|next)"
+    r"|day:(?P<dy>\d{4}):(?P<dm>\d{1,2}):(?P<dd>\d{1,2})"
+    r"|back:(?P<by>\d{4}):(?P<bm>\d{1,2}))"
+)
+
+
 @dp.callback_query(F.data.startswith("cal_lavori:"))
 async def calendario_lavori_handler(cb: CallbackQuery):
-    parts = cb.data.split(":")
-    action = parts[1]
-
-    if action == "ignore":
+    match = _CAL_LAVORI_RE.fullmatch(cb.data)
+    if match is None or match.lastindex is None:
+        # "ignore" o payload non riconosciuto
         await cb.answer()
         return
 
-    user_id_str = f"{cb.from_user.full_name} | {cb.from_user.id}"
+    user_id_str = _user_key(cb.from_user)
 
-    if action == "nav":
-        year, month, direction = int(parts[2]), int(parts[3]), parts[4]
+    if match["dir"]:
+        year, month, direction = int(match["ny"]), int(match["nm"]), match["dir"]
         if direction == "prev":
             month, year = (12, year - 1) if month == 1 else (month - 1, year)
         else:
             month, year = (1, year + 1) if month == 12 else (month + 1, year)
 
-        await cb.answer(f"⏳ Carico {mese_nome(month)} {year}…")
-
-        try:
-            lavori = await async_get_lavori_mese(user_id_str, year, month)
-        except asyncio.TimeoutError:
-            await cb.answer("⚠️ Timeout, riprova.", show_alert=True)
-            return
-
-        giorni_con_lavori = {r["data"] for r in lavori}
-        totale = len(lavori)
-
-        testo = (
-            f"📆 <b>Calendario Lavori — {mese_nome(month)} {year}</b>\n\n"
-            f"✅ = giorno con registrazioni  🔵 = oggi\n\n"
-            f"Lavori registrati questo mese: <b>{totale}</b>\n"
-            "Tocca un giorno evidenziato per vedere il dettaglio."
-        )
-
-        await cb.message.edit_text(
-            testo,
-            reply_markup=build_lavori_calendar(year, month, giorni_con_lavori),
-        )
+        await _edit_lavori_month(cb, user_id_str, year, month)
         return
 
-    if action == "day":
-        year, month, day = int(parts[2]), int(parts[3]), int(parts[4])
+    if match["dd"]:
+        year, month, day = int(match["dy"]), int(match["dm"]), int(match["dd"])
         giorno_str = f"{day:02d}.{month:02d}.{year}"
 
         await cb.answer(f"⏳ Carico {giorno_str}…")
@@ -1794,31 +2598,9 @@ async def calendario_lavori_handler(cb: CallbackQuery):
         )
         return
 
-    if action == "back":
-        year, month = int(parts[2]), int(parts[3])
-
-        await cb.answer(f"⏳ Carico {mese_nome(month)} {year}…")
-
-        try:
-            lavori = await async_get_lavori_mese(user_id_str, year, month)
-        except asyncio.TimeoutError:
-            await cb.answer("⚠️ Timeout, riprova.", show_alert=True)
-            return
-
-        giorni_con_lavori = {r["data"] for r in lavori}
-        totale = len(lavori)
-
-        testo = (
-            f"📆 <b>Calendario Lavori — {mese_nome(month)} {year}</b>\n\n"
-            f"✅ = giorno con registrazioni  🔵 = oggi\n\n"
-            f"Lavori registrati questo mese: <b>{totale}</b>\n"
-            "Tocca un giorno evidenziato per vedere il dettaglio."
-        )
-
-        await cb.message.edit_text(
-            testo,
-            reply_markup=build_lavori_calendar(year, month, giorni_con_lavori),
-        )
+    if match["by"]:
+        year, month = int(match["by"]), int(match["bm"])
+        await _edit_lavori_month(cb, user_id_str, year, month)
         return
 
     await cb.answer()
@@ -1827,59 +2609,82 @@ async def calendario_lavori_handler(cb: CallbackQuery):
 # ============================================================
 # Handlers – Istruzioni
 # ============================================================
+ISTRUZIONI_TEXT = (
+    "<b>📖 Guida al Bot Presenze</b>\n\n"
+
+    "<b>▶️ Avvio</b>\n"
+    "Invia /start per aprire il menu principale.\n\n"
+
+    "<b>🕓 Registrazione ingresso</b>\n"
+    "1. Premi <b>Ingresso</b>\n"
+    "2. Tocca il bottone 📍 <b>Invia posizione</b>\n"
+    "3. Il bot verifica che tu sia in una sede autorizzata e salva ora e luogo.\n"
+    "⚠️ Puoi registrare un solo ingresso al giorno.\n\n"
+
+    "<b>🚪 Registrazione uscita</b>\n"
+    "1. Premi <b>Uscita</b> e invia la posizione come sopra.\n"
+    "2. Il bot aggiorna il tuo registro con l'orario di uscita.\n"
+    "⚠️ È necessario aver già registrato l'ingresso nella stessa giornata.\n\n"
+
+    "<b>🔧 Registra Lavoro</b>\n"
+    "1. Premi <b>Registra Lavoro</b>\n"
+    "2. Inserisci il <b>numero del bus</b>\n"
+    "3. Seleziona il tipo: <b>Installazione</b> o <b>Manutenzione</b>\n"
+    "4. Scrivi eventuali note oppure premi <b>Salta</b>\n"
+    "Il lavoro viene salvato nel foglio Produttività con data e ora.\n\n"
+
+    "<b>📆 Calendario Lavori</b>\n"
+    "Mostra il calendario mensile dei tuoi lavori.\n"
+    "✅ = giorno con registrazioni  🔵 = oggi\n"
+    "Tocca un giorno evidenziato per vedere il dettaglio completo.\n"
+    "Naviga tra i mesi con ◀️ e ▶️.\n\n"
+
+    "<b>📝 Richiesta permessi</b>\n"
+    "1. Premi <b>Richiesta permessi</b>\n"
+    "2. Seleziona data inizio e fine dal calendario\n"
+    "3. Scrivi il motivo\n"
+    "La richiesta viene salvata nel foglio Permessi.\n\n"
+
+    "<b>📄 Riepilogo presenze</b>\n"
+    "Scegli anno e mese: riceverai un CSV con ingressi e uscite.\n\n"
+
+    "<b>🔔 Notifiche reminder</b>\n"
+    "Attiva/disattiva e configura gli orari dei reminder con /mienotifiche\n"
+    "I reminder non vengono inviati sabato e domenica.\n\n"
+
+    "<b>📍 Privacy</b>\n"
+    "Il bot NON traccia la posizione in automatico.\n"
+    "La posizione viene usata solo quando la invii manualmente.\n\n"
+
+    "<b>📧 Assistenza</b>\n"
+    "sserviceitalia@gmail.com – Shust Dmytro (3298333622)"
+)
+
+
+# (chat, message_id) di una guida già inviata: le richieste successive la
+# copiano con copy_message invece di rimandare e far rielaborare l'HTML.
+_istruzioni_msg: Optional[Tuple[int, int]] = None
+
+
 @dp.message(F.text == "📘 Istruzioni Bot")
 async def istruzioni_handler(message: Message):
-    istruzioni_text = (
-        "<b>📖 Guida al Bot Presenze</b>\n\n"
-
-        "<b>▶️ Avvio</b>\n"
-        "Invia /start per aprire il menu principale.\n\n"
-
-        "<b>🕓 Registrazione ingresso</b>\n"
-        "1. Premi <b>Ingresso</b>\n"
-        "2. Tocca il bottone 📍 <b>Invia posizione</b>\n"
-        "3. Il bot verifica che tu sia in una sede autorizzata e salva ora e luogo.\n"
-        "⚠️ Puoi registrare un solo ingresso al giorno.\n\n"
-
-        "<b>🚪 Registrazione uscita</b>\n"
-        "1. Premi <b>Uscita</b> e invia la posizione come sopra.\n"
-        "2. Il bot aggiorna il tuo registro con l'orario di uscita.\n"
-        "⚠️ È necessario aver già registrato l'ingresso nella stessa giornata.\n\n"
-
-        "<b>🔧 Registra Lavoro</b>\n"
-        "1. Premi <b>Registra Lavoro</b>\n"
-        "2. Inserisci il <b>numero del bus</b>\n"
-        "3. Seleziona il tipo: <b>Installazione</b> o <b>Manutenzione</b>\n"
-        "4. Scrivi eventuali note oppure premi <b>Salta</b>\n"
-        "Il lavoro viene salvato nel foglio Produttività con data e ora.\n\n"
-
-        "<b>📆 Calendario Lavori</b>\n"
-        "Mostra il calendario mensile dei tuoi lavori.\n"
-        "✅ = giorno con registrazioni  🔵 = oggi\n"
-        "Tocca un giorno evidenziato per vedere il dettaglio completo.\n"
-        "Naviga tra i mesi con ◀️ e ▶️.\n\n"
-
-        "<b>📝 Richiesta permessi</b>\n"
-        "1. Premi <b>Richiesta permessi</b>\n"
-        "2. Seleziona data inizio e fine dal calendario\n"
-        "3. Scrivi il motivo\n"
-        "La richiesta viene salvata nel foglio Permessi.\n\n"
-
-        "<b>📄 Riepilogo presenze</b>\n"
-        "Scegli anno e mese: riceverai un CSV con ingressi e uscite.\n\n"
-
-        "<b>🔔 Notifiche reminder</b>\n"
-        "Attiva/disattiva e configura gli orari dei reminder con /mienotifiche\n"
-        "I reminder non vengono inviati sabato e domenica.\n\n"
-
-        "<b>📍 Privacy</b>\n"
-        "Il bot NON traccia la posizione in automatico.\n"
-        "La posizione viene usata solo quando la invii manualmente.\n\n"
-
-        "<b>📧 Assistenza</b>\n"
-        "sserviceitalia@gmail.com – Shust Dmytro (3298333622)"
-    )
-    await message.answer(istruzioni_text, reply_markup=main_kb)
+    global _istruzioni_msg
+    if _istruzioni_msg is not None:
+        from_chat_id, message_id = _istruzioni_msg
+        try:
+            await bot.copy_message(
+                chat_id=message.chat.id,
+                from_chat_id=from_chat_id,
+                message_id=message_id,
+                reply_markup=main_kb,
+            )
+            return
+        except Exception as e:
+            # Messaggio originale cancellato o chat non più accessibile
+            logger.info("Copia istruzioni non riuscita, le rimando: %s", e)
+            _istruzioni_msg = None
+    sent = await message.answer(ISTRUZIONI_TEXT, reply_markup=main_kb)
+    _istruzioni_msg = (sent.chat.id, sent.message_id)
 
 
 # ============================================================
@@ -2042,7 +2847,15 @@ async def zone_new_name_handler(message: Message, state: FSMContext):
 # ============================================================
 # Scheduler / Reminders
 # ============================================================
+# I reminder escono a raffica alla stessa ora: restano sotto i 25 msg/s così
+# una parte dei 30/s di TelegramRateLimit resta libera per le risposte agli utenti.
+_reminder_bucket = _TokenBucket(25.0, 25.0)
+
+
 async def send_reminder(user_id: int, text: str) -> None:
+    delay = _reminder_bucket.reserve()
+    if delay:
+        await asyncio.sleep(delay)
     try:
         await bot.send_message(user_id, text)
         logger.info("Reminder inviato a %s", user_id)
@@ -2050,93 +2863,153 @@ async def send_reminder(user_id: int, text: str) -> None:
         logger.error("Errore invio reminder a %s: %s", user_id, e)
 
 
+# Invii contemporanei al massimo: il ritmo lo regolano _reminder_bucket e
+# TelegramRateLimit, qui si limitano solo le richieste in volo.
+_REMINDER_CONCURRENCY = 20
+
+
+async def send_reminders(reminders: List[Tuple[int, str]]) -> None:
+    semaphore = asyncio.Semaphore(_REMINDER_CONCURRENCY)
+
+    async def _one(user_id: int, text: str) -> None:
+        async with semaphore:
+            await send_reminder(user_id, text)
+
+    await asyncio.gather(*(_one(user_id, text) for user_id, text in reminders))
+
+
 _notifiche_cache: Dict[int, dict] = {}
-_notifiche_cache_time: Optional[datetime] = None
+_notifiche_cache_time: Optional[float] = None  # time.monotonic()
 _NOTIFICHE_TTL = 300
 
+# Riferimento forte al task: asyncio tiene solo weakref ai task creati,
+# senza questo lo scheduler può essere raccolto dal GC e smettere di girare.
+_scheduler_task: Optional[asyncio.Task] = None
+# Sveglia lo scheduler quando cambiano le impostazioni (può arrivare da un thread).
+_scheduler_wakeup: Optional[asyncio.Event] = None
+_scheduler_event_loop: Optional[asyncio.AbstractEventLoop] = None
+
 
 def _invalidate_notifiche_cache() -> None:
     global _notifiche_cache, _notifiche_cache_time
     _notifiche_cache = {}
     _notifiche_cache_time = None
+    if _scheduler_wakeup is not None and _scheduler_event_loop is not None:
+        _scheduler_event_loop.call_soon_threadsafe(_scheduler_wakeup.set)
 
 
 async def _get_notifiche_cached() -> Dict[int, dict]:
     global _notifiche_cache, _notifiche_cache_time
-    now = datetime.now(TIMEZONE)
-    if (
-        _notifiche_cache_time is not None
-        and (now - _notifiche_cache_time).total_seconds() < _NOTIFICHE_TTL
-    ):
+    now = time.monotonic()
+    if _notifiche_cache_time is not None and now - _notifiche_cache_time < _NOTIFICHE_TTL:
         return _notifiche_cache
     _notifiche_cache = await sheets_call(get_notifiche_settings)
     _notifiche_cache_time = now
     return _notifiche_cache
 
 
+def _seconds_to_next_reminder(settings: Dict[int, dict], now: datetime) -> float:
+    """Secondi fino al prossimo orario di reminder attivo di oggi, o fino a mezzanotte."""
+    hhmm = hhmm_str(now)
+    upcoming = [
+        orario
+        for cfg in settings.values()
+        for attivo, orario in (
+            (cfg["reminder_ingresso"], cfg["orario_ingresso"]),
+            (cfg["reminder_uscita"], cfg["orario_uscita"]),
+        )
+        if attivo and orario > hhmm
+    ]
+    if upcoming:
+        h, m = min(upcoming).split(":")
+        target = now.replace(hour=int(h), minute=int(m), second=0, microsecond=0)
+        if target > now:
+            return (target - now).total_seconds()
+    # Nessun reminder ancora da inviare oggi: sveglia a mezzanotte.
+    target = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (target - now).total_seconds()
+
+
 async def scheduler_loop() -> None:
-    logger.info("Scheduler loop avviato (controllo ogni 30s, per-utente)")
+    global _scheduler_wakeup, _scheduler_event_loop
+    _scheduler_wakeup = asyncio.Event()
+    _scheduler_event_loop = asyncio.get_running_loop()
+    logger.info("Scheduler loop avviato (sveglia al prossimo orario di reminder)")
+    # Ogni giro invia i reminder con orario in (ultimo giro, adesso]: un orario
+    # scatta una volta sola anche se lo scheduler viene svegliato più volte nello
+    # stesso minuto, e uno saltato per un giro in ritardo o fallito non va perso.
+    last_check = datetime.now(TIMEZONE) - timedelta(minutes=1)
     try:
         while True:
+            # Nei feriali non si dorme oltre la validità della cache Notifiche:
+            # il foglio può essere modificato a mano.
+            delay = float(_NOTIFICHE_TTL)
+            settings: Dict[int, dict] = {}
             try:
                 now = datetime.now(TIMEZONE)
+                if _today != today_str(now):
+                    # Primo giro dopo mezzanotte: indice del nuovo giorno pronto
+                    try:
+                        await sheets_call(_sync_prewarm_today_index, today_str(now))
+                    except Exception as e:
+                        logger.warning("Indice Registro di oggi non precaricato: %s", e)
                 if now.weekday() < 5:
-                    hhmm = now.strftime("%H:%M")
-                    today = now.strftime("%d.%m.%Y")
-                    today_date = now.date()
+                    hhmm = hhmm_str(now)
+                    today = today_str(now)
+                    since = hhmm_str(last_check) if last_check.date() == now.date() else ""
 
                     settings = await _get_notifiche_cached()
 
                     needs_ingresso = [
                         (uid, cfg) for uid, cfg in settings.items()
                         if cfg["reminder_ingresso"]
-                        and cfg["orario_ingresso"] == hhmm
-                        and _sent_ingresso_today.get(uid) != today_date
+                        and since < cfg["orario_ingresso"] <= hhmm
                     ]
                     needs_uscita = [
                         (uid, cfg) for uid, cfg in settings.items()
                         if cfg["reminder_uscita"]
-                        and cfg["orario_uscita"] == hhmm
-                        and _sent_uscita_today.get(uid) != today_date
+                        and since < cfg["orario_uscita"] <= hhmm
                     ]
 
                     if needs_ingresso or needs_uscita:
-                        sheet_reg = await sheets_call(get_sheet, "Registro")
-                        reg_rows = await asyncio.to_thread(sheet_reg.get_all_values)
-                        entered_today = {
-                            row[1] for row in reg_rows[1:]
-                            if len(row) > 2 and row[0] == today and row[2]
-                        }
-                        exited_today = {
-                            row[1] for row in reg_rows[1:]
-                            if len(row) > 4 and row[0] == today and row[4]
-                        }
-
-                        for uid, cfg in needs_ingresso:
-                            has_entered = any(s.endswith(f"| {uid}") for s in entered_today)
-                            if not has_entered:
-                                await send_reminder(
-                                    uid,
-                                    f"🔔 Ciao {cfg['nome']}, ricorda di registrare l'ingresso!"
-                                )
-                            _sent_ingresso_today[uid] = today_date
-
-                        for uid, cfg in needs_uscita:
-                            has_entered = any(s.endswith(f"| {uid}") for s in entered_today)
-                            has_exited = any(s.endswith(f"| {uid}") for s in exited_today)
-                            if has_entered and not has_exited:
-                                await send_reminder(
-                                    uid,
-                                    f"🔔 Ciao {cfg['nome']}, ricorda di registrare l'uscita!"
-                                )
-                            _sent_uscita_today[uid] = today_date
+                        entered_ids, exited_ids = await sheets_call(_sync_today_presence, today)
+
+                        reminders = [
+                            (uid, f"🔔 Ciao {cfg['nome']}, ricorda di registrare l'ingresso!")
+                            for uid, cfg in needs_ingresso
+                            if uid not in entered_ids
+                        ]
+                        reminders += [
+                            (uid, f"🔔 Ciao {cfg['nome']}, ricorda di registrare l'uscita!")
+                            for uid, cfg in needs_uscita
+                            if uid in entered_ids and uid not in exited_ids
+                        ]
+                        await send_reminders(reminders)
+                # Finestra chiusa appena gli invii sono fatti: un errore da qui
+                # in poi non deve far ripartire gli stessi reminder.
+                last_check = now
 
             except asyncio.CancelledError:
                 raise
             except Exception as e:
                 logger.exception("Errore nel scheduler loop: %s", e)
 
-            await asyncio.sleep(30)
+            try:
+                now = datetime.now(TIMEZONE)
+                if now.weekday() < 5:
+                    delay = min(_seconds_to_next_reminder(settings, now), _NOTIFICHE_TTL)
+                else:
+                    delay = _seconds_to_next_reminder({}, now)
+                delay = max(delay, 1.0)
+            except Exception as e:
+                logger.exception("Errore calcolo prossimo reminder: %s", e)
+                delay = float(_NOTIFICHE_TTL)
+
+            try:
+                await asyncio.wait_for(_scheduler_wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            _scheduler_wakeup.clear()
     except asyncio.CancelledError:
         logger.info("Scheduler loop terminato.")
 
@@ -2144,7 +3017,7 @@ async def scheduler_loop() -> None:
 # ============================================================
 # Handlers – /mienotifiche
 # ============================================================
-def _build_notif_kb_user(uid: int, cfg: dict) -> types.InlineKeyboardMarkup:
+def _build_notif_kb(uid: int, cfg: dict, admin: bool = False) -> types.InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     stato_in = "✅ Attivo" if cfg["reminder_ingresso"] else "❌ Disattivo"
     stato_out = "✅ Attivo" if cfg["reminder_uscita"] else "❌ Disattivo"
@@ -2152,6 +3025,8 @@ def _build_notif_kb_user(uid: int, cfg: dict) -> types.InlineKeyboardMarkup:
     kb.button(text=f"⏰ Orario ingresso: {cfg['orario_ingresso']}  ✏️", callback_data=f"notif:set_orario_in:{uid}")
     kb.button(text=f"🚪 Reminder uscita: {stato_out}", callback_data=f"notif:toggle_out:{uid}")
     kb.button(text=f"⏰ Orario uscita: {cfg['orario_uscita']}  ✏️", callback_data=f"notif:set_orario_out:{uid}")
+    if admin:
+        kb.button(text="🔙 Torna alla lista", callback_data="notif:admin_list")
     kb.adjust(1)
     return kb.as_markup()
 
@@ -2169,13 +3044,22 @@ async def mienotifiche_handler(message: Message):
     cfg = settings[uid]
     await message.answer(
         "🔔 <b>Le tue notifiche</b>\n\nTocca un bottone per attivare/disattivare o cambiare l'orario:",
-        reply_markup=_build_notif_kb_user(uid, cfg),
+        reply_markup=_build_notif_kb(uid, cfg),
     )
 
 
 # ============================================================
 # Handlers – /notifiche (admin)
 # ============================================================
+def _build_notif_users_kb(settings: Dict[int, dict]) -> types.InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
+    for uid, cfg in settings.items():
+        stato = "✅" if (cfg["reminder_ingresso"] or cfg["reminder_uscita"]) else "❌"
+        kb.button(text=f"{stato} {cfg['nome']}", callback_data=f"notif:admin_user:{uid}")
+    kb.adjust(1)
+    return kb.as_markup()
+
+
 @dp.message(F.text == "/notifiche")
 async def notifiche_admin_handler(message: Message):
     if message.from_user.id not in ADMINS:
@@ -2185,14 +3069,9 @@ async def notifiche_admin_handler(message: Message):
     if not settings:
         await message.answer("❌ Nessun utente nel foglio Notifiche.")
         return
-    kb = InlineKeyboardBuilder()
-    for uid, cfg in settings.items():
-        stato = "✅" if (cfg["reminder_ingresso"] or cfg["reminder_uscita"]) else "❌"
-        kb.button(text=f"{stato} {cfg['nome']}", callback_data=f"notif:admin_user:{uid}")
-    kb.adjust(1)
     await message.answer(
         "👥 <b>Gestione notifiche utenti</b>\n\nSeleziona un utente:",
-        reply_markup=kb.as_markup(),
+        reply_markup=_build_notif_users_kb(settings),
     )
 
 
@@ -2215,37 +3094,19 @@ async def notif_admin_user_handler(cb: CallbackQuery):
         f"🕓 Ingresso: {in_stato} — {cfg['orario_ingresso']}\n"
         f"🚪 Uscita: {out_stato} — {cfg['orario_uscita']}"
     )
-    await cb.message.edit_text(testo, reply_markup=_build_notif_kb_admin(uid, cfg))
+    await cb.message.edit_text(testo, reply_markup=_build_notif_kb(uid, cfg, admin=True))
     await cb.answer()
 
 
-def _build_notif_kb_admin(uid: int, cfg: dict) -> types.InlineKeyboardMarkup:
-    kb = InlineKeyboardBuilder()
-    stato_in = "✅ Attivo" if cfg["reminder_ingresso"] else "❌ Disattivo"
-    stato_out = "✅ Attivo" if cfg["reminder_uscita"] else "❌ Disattivo"
-    kb.button(text=f"🕓 Reminder ingresso: {stato_in}", callback_data=f"notif:toggle_in:{uid}")
-    kb.button(text=f"⏰ Orario ingresso: {cfg['orario_ingresso']}  ✏️", callback_data=f"notif:set_orario_in:{uid}")
-    kb.button(text=f"🚪 Reminder uscita: {stato_out}", callback_data=f"notif:toggle_out:{uid}")
-    kb.button(text=f"⏰ Orario uscita: {cfg['orario_uscita']}  ✏️", callback_data=f"notif:set_orario_out:{uid}")
-    kb.button(text="🔙 Torna alla lista", callback_data="notif:admin_list")
-    kb.adjust(1)
-    return kb.as_markup()
-
-
 @dp.callback_query(F.data == "notif:admin_list")
 async def notif_admin_list_handler(cb: CallbackQuery):
     if cb.from_user.id not in ADMINS:
         await cb.answer("❌ Non autorizzato.", show_alert=True)
         return
     settings = await sheets_call(get_notifiche_settings)
-    kb = InlineKeyboardBuilder()
-    for uid, cfg in settings.items():
-        stato = "✅" if (cfg["reminder_ingresso"] or cfg["reminder_uscita"]) else "❌"
-        kb.button(text=f"{stato} {cfg['nome']}", callback_data=f"notif:admin_user:{uid}")
-    kb.adjust(1)
     await cb.message.edit_text(
         "👥 <b>Gestione notifiche utenti</b>\n\nSeleziona un utente:",
-        reply_markup=kb.as_markup(),
+        reply_markup=_build_notif_users_kb(settings),
     )
     await cb.answer()
 
@@ -2274,7 +3135,7 @@ async def notif_toggle_handler(cb: CallbackQuery):
         return
     cfg = settings[uid]
     is_admin_view = cb.from_user.id in ADMINS and cb.from_user.id != uid
-    new_kb = _build_notif_kb_admin(uid, cfg) if is_admin_view else _build_notif_kb_user(uid, cfg)
+    new_kb = _build_notif_kb(uid, cfg, admin=is_admin_view)
     try:
         await cb.message.edit_reply_markup(reply_markup=new_kb)
     except Exception:
@@ -2302,7 +3163,7 @@ async def notif_set_orario_start(cb: CallbackQuery, state: FSMContext):
 @dp.message(NotificheForm.waiting_for_orario)
 async def notif_set_orario_receive(message: Message, state: FSMContext):
     testo = (message.text or "").strip()
-    if not re.match(r"^([01]\d|2[0-3]):[0-5]\d$", testo):
+    if not _ORARIO_RE.fullmatch(testo):
         await message.answer("❌ Formato non valido. Scrivi l'orario come <code>HH:MM</code>, es. <code>08:30</code>")
         return
 
@@ -2332,15 +3193,14 @@ async def remindtest_handler(message: Message):
         return
     await message.answer("⏳ Eseguo test scheduler…")
     settings = await sheets_call(get_notifiche_settings)
-    count = 0
+    reminders = []
     for uid, cfg in settings.items():
         if cfg["reminder_ingresso"]:
-            await send_reminder(uid, f"🔔 [TEST] Ciao {cfg['nome']}, reminder ingresso di prova!")
-            count += 1
+            reminders.append((uid, f"🔔 [TEST] Ciao {cfg['nome']}, reminder ingresso di prova!"))
         if cfg["reminder_uscita"]:
-            await send_reminder(uid, f"🔔 [TEST] Ciao {cfg['nome']}, reminder uscita di prova!")
-            count += 1
-    await message.answer(f"✅ Inviati {count} reminder di test.")
+            reminders.append((uid, f"🔔 [TEST] Ciao {cfg['nome']}, reminder uscita di prova!"))
+    await send_reminders(reminders)
+    await message.answer(f"✅ Inviati {len(reminders)} reminder di test.")
 
 
 # ============================================================
@@ -2419,14 +3279,24 @@ def _handle_task_exception(loop, context):
 
 
 async def on_startup() -> None:
-    global _sheets_semaphore
+    global _sheets_semaphore, _scheduler_task, _write_q, _write_flusher_task
     _sheets_semaphore = asyncio.Semaphore(3)
+    _write_q = asyncio.Queue()
+    _write_flusher_task = asyncio.create_task(_write_flusher())
 
     loop = asyncio.get_event_loop()
     loop.set_exception_handler(_handle_task_exception)
+    # Le chiamate Sheets hanno il loro pool (_sheets_executor), ma restano sul
+    # default executor i to_thread che possono bloccarsi a lungo:
+    # get_work_locations legge ZoneLavoro senza il timeout di sheets_call, e
+    # _sync_settle_ingresso aspetta _registro_lock mentre un altro thread la
+    # tiene durante una lettura del Registro. Con il pool di default (cpu + 4
+    # thread, pochi su un dyno piccolo) qualche attesa così basta a esaurirlo.
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=32, thread_name_prefix="bot-io"))
 
     try:
         await sheets_call(init_sheets)
+        await sheets_call(_sync_prewarm_today_index, today_str())
     except Exception as e:
         logger.error("Init Sheets fallito (bot parte comunque): %s", e)
 
@@ -2442,36 +3312,103 @@ async def on_startup() -> None:
             "WEBHOOK_URL non impostato: il webhook NON è stato registrato su Telegram."
         )
 
-    asyncio.create_task(scheduler_loop())
+    _scheduler_task = asyncio.create_task(scheduler_loop())
     logger.info("Startup completato.")
 
 
+async def on_shutdown() -> None:
+    # Prima gli update già ricevuti da Telegram: i loro handler possono ancora
+    # mettere scritture in coda, che il flusher deve trovare attivo.
+    if _update_tasks:
+        _, pending = await asyncio.wait(set(_update_tasks), timeout=10)
+        if pending:
+            logger.error("Shutdown: %d update non completati.", len(pending))
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(pending)
+    if _write_q is not None:
+        try:
+            await asyncio.wait_for(_write_q.join(), timeout=15)
+        except asyncio.TimeoutError:
+            logger.error("Shutdown: %d scritture in coda non completate.", _write_q.qsize())
+    for task in (_write_flusher_task, _scheduler_task):
+        if task is None:
+            continue
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    _sheets_executor.shutdown(wait=False, cancel_futures=True)
+    await dp.storage.close()
+    await bot.session.close()
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await on_startup()
     yield
+    await on_shutdown()
     logger.info("Shutdown completato.")
 
 
 app = FastAPI(lifespan=lifespan)
 
 
-async def _process_update(update: types.Update) -> None:
+# Gli update si elaborano in background, ma quelli dello stesso utente uno
+# dopo l'altro: i flussi FSM (ingresso, permessi, ...) dipendono dall'ordine.
+# _update_tasks tiene i riferimenti forti (asyncio conserva solo weakref),
+# _user_update_tails l'ultimo update in coda per ogni utente.
+_update_tasks: set = set()
+_user_update_tails: Dict[int, asyncio.Task] = {}
+
+
+def _update_user_id(update: types.Update) -> Optional[int]:
+    try:
+        user = getattr(update.event, "from_user", None)
+    except Exception:
+        return None
+    return user.id if user is not None else None
+
+
+async def _process_update(update: types.Update, previous: Optional[asyncio.Task] = None) -> None:
+    if previous is not None:
+        await asyncio.wait((previous,))
     try:
         await dp.feed_update(bot=bot, update=update)
     except Exception as e:
         logger.exception("Errore processando update: %s", e)
 
 
+def _schedule_update(update: types.Update) -> None:
+    user_id = _update_user_id(update)
+    previous = _user_update_tails.get(user_id) if user_id is not None else None
+    task = asyncio.create_task(_process_update(update, previous))
+    _update_tasks.add(task)
+    task.add_done_callback(_update_tasks.discard)
+    if user_id is not None:
+        _user_update_tails[user_id] = task
+
+        def _release(t: asyncio.Task) -> None:
+            if _user_update_tails.get(user_id) is t:
+                del _user_update_tails[user_id]
+
+        task.add_done_callback(_release)
+
+
+# Risposta già serializzata: evita jsonable_encoder + json.dumps a ogni update.
+_WEBHOOK_OK = b'{"ok":true}'
+
+
 @app.post("/webhook")
 async def webhook(request: Request):
     try:
-        update = types.Update.model_validate(await request.json(), context={"bot": bot})
-        asyncio.create_task(_process_update(update))
-        return {"ok": True}
+        # Il parser JSON di pydantic-core valida direttamente i byte del body.
+        update = types.Update.model_validate_json(await request.body(), context={"bot": bot})
+        _schedule_update(update)
     except Exception as e:
         logger.exception("Errore parsing webhook: %s", e)
-        return {"ok": True}
+    return Response(content=_WEBHOOK_OK, media_type="application/json")
 
 
 @app.api_route("/", methods=["GET", "HEAD"])
@@ -2513,4 +3450,13 @@ async def debug_endpoint():
 if __name__ == "__main__":
     import uvicorn
     logger.info("Avvio uvicorn FastAPI + webhook")
-    uvicorn.run("bot:app", host="0.0.0.0", port=PORT, log_level="info")
+    uvicorn.run(
+        "bot:app",
+        host="0.0.0.0",
+        port=PORT,
+        log_level="info",
+        # uvloop non esiste su Windows (vedi requirements.txt)
+        loop="asyncio" if os.name == "nt" else "uvloop",
+        http="httptools",
+        workers=1,
+    )